@@ -0,0 +1,442 @@
+#!/usr/bin/python3
+"""Benchmark of the scrape to export path, times each export's publish().
+
+A synthetic scrape of every register in the registers file is decoded by
+SungrowClient from simulator.py values, then published to each export
+configured in the config file (config-example.yaml by default). MQTT,
+InfluxDB and PVOutput are pointed at local stand-ins, so nothing leaves
+the machine. Results are appended to a JSON file and compared with the
+last run of a different version on the same machine.
+"""
+
+from SungrowClient import SungrowClient
+from version import __version__
+from simulator import SimulatedInverter
+from scanplan import build_scan_plan
+from registercache import YamlLoader
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import contextlib
+import copy
+import gc
+import getopt
+import importlib
+import json
+import logging
+import os
+import platform
+import socketserver
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+import yaml
+
+EXPORTS = ("console", "webserver", "api", "mqtt", "influxdb", "pvoutput", "pvoutput_upload")
+
+class LoopbackResponse(object):
+    def __init__(self, registers):
+        self.registers = registers
+
+    def isError(self):
+        return False
+
+
+class LoopbackClient(object):
+    """Stands in for the pymodbus client, registers come straight from a SimulatedInverter"""
+    def __init__(self, simulated):
+        self.simulated = simulated
+
+    def read_input_registers(self, start, count=1, unit=1):
+        return LoopbackResponse(self.simulated.read("read", start, count))
+
+    def read_holding_registers(self, start, count=1, unit=1):
+        return LoopbackResponse(self.simulated.read("hold", start, count))
+
+    def is_socket_open(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class MQTTBrokerHandler(socketserver.BaseRequestHandler):
+    """Just enough of MQTT 3.1.1 for paho: CONNACK, PUBACK for QoS 1, PINGRESP"""
+    def _recv(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def handle(self):
+        while True:
+            header = self._recv(1)
+            if header is None:
+                return
+            # Remaining length is a variable length integer
+            length, multiplier = 0, 1
+            while True:
+                byte = self._recv(1)
+                if byte is None:
+                    return
+                length += (byte[0] & 0x7F) * multiplier
+                multiplier *= 128
+                if not byte[0] & 0x80:
+                    break
+            body = self._recv(length) if length else b''
+            if body is None:
+                return
+            packet_type = header[0] >> 4
+            if packet_type == 1:
+                self.request.sendall(b'\x20\x02\x00\x00')
+            elif packet_type == 3:
+                self.server.stats["messages"] += 1
+                self.server.stats["bytes"] += length
+                if (header[0] >> 1) & 0x03:
+                    topic_length = int.from_bytes(body[0:2], 'big')
+                    self.request.sendall(b'\x40\x02' + body[2 + topic_length:4 + topic_length])
+            elif packet_type == 12:
+                self.request.sendall(b'\xd0\x00')
+            elif packet_type == 14:
+                return
+
+
+class MQTTBroker(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        self.stats = {"messages": 0, "bytes": 0}
+        super().__init__(('127.0.0.1', 0), MQTTBrokerHandler)
+
+
+class HTTPEndpointHandler(BaseHTTPRequestHandler):
+    """Answers InfluxDB writes and the PVOutput service calls"""
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if length:
+            self.rfile.read(length)
+        self.server.stats["requests"] += 1
+        self.server.stats["bytes"] += length
+        if "getsystem.jsp" in self.path:
+            # name,size,postcode,panels,panel_power,panel_brand,inverters,inverter_power,inverter_brand,orientation,array_tilt,shade,install_date,latitude,longitude,status_interval;;teams
+            self._reply(200, b"Benchmark,10000,0000,20,500,Panel,1,10000,Sungrow,N,20,No,20240101,0,0,5;;1618")
+        elif "/api/v2/write" in self.path or "/write" in self.path:
+            self._reply(204, b"")
+        else:
+            self._reply(200, b"OK 200: Added Status")
+
+    do_GET = do_POST
+
+    def _reply(self, code, body):
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HTTPEndpoint(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        self.stats = {"requests": 0, "bytes": 0}
+        super().__init__(('127.0.0.1', 0), HTTPEndpointHandler)
+
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def build_inverter(registersfile, model, serial_number):
+    """SungrowClient holding a scrape of every register in the registers file"""
+    inverter = SungrowClient.SungrowClient({
+        "host": "127.0.0.1",
+        "port": 502,
+        "timeout": 10,
+        "retries": 3,
+        "slave": 1,
+        "scan_interval": 30,
+        "level": 3,
+        "model": model,
+        "serial_number": serial_number,
+        "connection": "modbus",
+        "use_local_time": False,
+        "smart_meter": True
+    })
+    for register_type in ("read", "hold"):
+        for register in registersfile['registers'][0 if register_type == "read" else 1][register_type]:
+            register = dict(register, type=register_type)
+            register.pop('level', None)
+            inverter.registers.append(register)
+    inverter.register_ranges = build_scan_plan(inverter.registers)
+    inverter.client = LoopbackClient(SimulatedInverter(registersfile, None, serial_number))
+    if not inverter.scrape():
+        sys.exit("Failed: Building synthetic scrape")
+    return inverter
+
+
+def export_configs(config, mqtt_port, http_url):
+    """Export configs from the config file, pointed at the local stand-ins"""
+    configs = {}
+    for export in config.get('exports', []):
+        configs[export.get('name')] = copy.deepcopy(export)
+    configs.setdefault('console', {"name": "console"})
+    configs.setdefault('webserver', {"name": "webserver"})
+    configs.setdefault('api', {"name": "api"})
+    configs['webserver']['port'] = 0
+    configs['api']['port'] = 0
+    configs['api']['host'] = '127.0.0.1'
+    if 'mqtt' in configs:
+        configs['mqtt'].update({"host": "127.0.0.1", "port": mqtt_port, "username": None, "password": None})
+    if 'influxdb' in configs:
+        # Buffers kept in memory, points left from an earlier run would skew the timings
+        configs['influxdb'].update({"url": http_url, "token": "benchmark", "org": "benchmark", "bucket": "benchmark", "buffer": False})
+    if 'pvoutput' in configs:
+        configs['pvoutput'].update({"api": "benchmark", "sid": "1", "join_team": False, "batch_points": 1, "backlog": False})
+        configs['pvoutput_upload'] = configs['pvoutput']
+    return configs
+
+
+def load_export(name, config, inverter, http_url):
+    module = "pvoutput" if name == "pvoutput_upload" else name
+    export = getattr(importlib.import_module(f"exports.{module}"), f"export_{module}")()
+    if module == "pvoutput":
+        for attr in ("url_addbatchstatus", "url_jointeam", "url_leaveteam", "url_getsystem"):
+            setattr(export, attr, getattr(export, attr).replace(export.url_base, f"{http_url}/service/r2/"))
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        if not export.configure(config, inverter):
+            return None
+    return export
+
+
+def bench_export(name, export, inverter, iterations, warmup):
+    """Time, CPU and memory per publish() call.
+
+    CPython has no allocation counter, memory is reported as the peak allocated
+    during a call (peak_kib) and memory blocks still held after it (retained_blocks).
+    """
+    def call():
+        if name == "pvoutput_upload":
+            # Force the upload path every call, normally it runs every status_interval
+            export.last_publish = 0
+        return export.publish(inverter)
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(warmup):
+            call()
+
+        gc.collect()
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        durations = []
+        cpu_start = time.process_time()
+        for _ in range(iterations):
+            start = time.perf_counter()
+            call()
+            durations.append(time.perf_counter() - start)
+        cpu = (time.process_time() - cpu_start) / iterations
+        if gc_was_enabled:
+            gc.enable()
+
+        # Memory pass, tracemalloc slows every allocation so it is kept out of the timings
+        memory_iterations = max(1, iterations // 10)
+        gc.collect()
+        blocks_start = sys.getallocatedblocks()
+        tracemalloc.start()
+        peaks = []
+        for _ in range(memory_iterations):
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            call()
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+        tracemalloc.stop()
+        gc.collect()
+        retained = (sys.getallocatedblocks() - blocks_start) / memory_iterations
+
+    durations.sort()
+    return {
+        "iterations": iterations,
+        "mean_ms": round(statistics.mean(durations) * 1000, 4),
+        "median_ms": round(statistics.median(durations) * 1000, 4),
+        "p95_ms": round(durations[int(len(durations) * 0.95) - 1] * 1000, 4),
+        "min_ms": round(durations[0] * 1000, 4),
+        "cpu_ms": round(cpu * 1000, 4),
+        "retained_blocks": round(retained, 1),
+        "peak_kib": round(max(peaks) / 1024, 1)
+    }
+
+
+def machine():
+    return f"{platform.node()} {platform.machine()} {platform.python_implementation()} {platform.python_version()}"
+
+
+def compare(results, history, threshold):
+    """Previous run of a different version on this machine, with the change of each export"""
+    previous = None
+    for run in reversed(history):
+        if run.get('machine') == results['machine'] and run.get('version') != results['version']:
+            previous = run
+            break
+    if not previous:
+        return None, []
+    changes = []
+    for name, result in results['exports'].items():
+        before = previous['exports'].get(name)
+        if not before or not before.get('median_ms'):
+            continue
+        change = (result['median_ms'] - before['median_ms']) / before['median_ms'] * 100
+        changes.append((name, before['median_ms'], result['median_ms'], change, change > threshold))
+    return previous, changes
+
+
+def main():
+    configfilename = 'config-example.yaml'
+    registersfilename = 'registers-sungrow.yaml'
+    resultsfilename = 'benchmark-results.json'
+    model = 'SH10RT'
+    serial_number = 'A221000001'
+    iterations = 200
+    warmup = 10
+    threshold = 10.0
+    selected = list(EXPORTS)
+    save = True
+    loglevel = logging.WARNING
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hc:r:o:n:e:v:", ["warmup=", "threshold=", "nosave"])
+    except getopt.GetoptError as err:
+        sys.exit(f'{err}, use -h to see all options')
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print(f'\nSunGather Benchmark {__version__}')
+            print(f'usage: python3 benchmark.py [options]')
+            print(f'\nOptions and arguments:')
+            print(f'-c config.yaml             : Config file with the exports to benchmark (default config-example.yaml)')
+            print(f'-r registers-file.yaml     : Specify registers file.')
+            print(f'-o results.json            : Results file, runs are appended (default benchmark-results.json)')
+            print(f'-n 200                     : Timed publish() calls per export')
+            print(f'-e mqtt,influxdb           : Exports to benchmark, default: {",".join(EXPORTS)}')
+            print(f'-v 30                      : Logging Level, 10 = Debug, 20 = Info, 30 = Warning (default), 40 = Error')
+            print(f'--warmup 10                : Untimed publish() calls before timing')
+            print(f'--threshold 10             : Median slow down in % reported as a regression')
+            print(f'--nosave                   : Do not append the results to the results file')
+            print(f'-h                         : print this help message and exit')
+            print(f'\nExample:')
+            print(f'python3 benchmark.py -n 500 -e webserver,api\n')
+            sys.exit()
+        elif opt == '-c':
+            configfilename = arg
+        elif opt == '-r':
+            registersfilename = arg
+        elif opt == '-o':
+            resultsfilename = arg
+        elif opt == '-n':
+            iterations = max(1, int(arg))
+        elif opt == '-e':
+            selected = [name.strip() for name in arg.split(',')]
+        elif opt == '-v':
+            loglevel = int(arg)
+        elif opt == '--warmup':
+            warmup = int(arg)
+        elif opt == '--threshold':
+            threshold = float(arg)
+        elif opt == '--nosave':
+            save = False
+
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=loglevel, datefmt='%Y-%m-%d %H:%M:%S')
+
+    try:
+        with open(configfilename, encoding='utf-8') as f:
+            config = yaml.load(f, Loader=YamlLoader)
+        with open(registersfilename, encoding='utf-8') as f:
+            registersfile = yaml.load(f, Loader=YamlLoader)
+    except Exception as err:
+        sys.exit(f"Failed: Loading config or registers: {err}")
+
+    inverter = build_inverter(registersfile, model, serial_number)
+    broker = serve(MQTTBroker())
+    endpoint = serve(HTTPEndpoint())
+    http_url = f"http://127.0.0.1:{endpoint.server_address[1]}"
+    configs = export_configs(config, broker.server_address[1], http_url)
+
+    results = {
+        "version": __version__,
+        "machine": machine(),
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "registers": len(inverter.latest_scrape),
+        "exports": {}
+    }
+    print(f"SunGather {__version__} benchmark, {results['registers']} registers, {iterations} calls per export on {results['machine']}")
+    print(f"{'Export':<16} {'Median ms':>10} {'p95 ms':>10} {'CPU ms':>10} {'Retained':>10} {'Peak KiB':>10}")
+
+    for name in selected:
+        if name not in EXPORTS:
+            logging.warning(f"Unknown export {name}, Valid options are: {', '.join(EXPORTS)}")
+            continue
+        if name not in configs:
+            logging.warning(f"{name} is not in {configfilename}, skipped")
+            continue
+        try:
+            export = load_export(name, configs[name], inverter, http_url)
+        except Exception as err:
+            logging.warning(f"{name}: Failed to load: {err}")
+            continue
+        if not export:
+            logging.warning(f"{name}: Failed to configure, skipped")
+            continue
+        if name == "mqtt":
+            # Wait for the connection, otherwise every publish is queued by paho
+            deadline = time.monotonic() + 5
+            while not export.mqtt_client.is_connected() and time.monotonic() < deadline:
+                time.sleep(0.05)
+
+        result = bench_export(name, export, inverter, iterations, warmup)
+        results['exports'][name] = result
+        print(f"{name:<16} {result['median_ms']:>10} {result['p95_ms']:>10} {result['cpu_ms']:>10} {result['retained_blocks']:>10} {result['peak_kib']:>10}")
+
+        if name == "mqtt":
+            export.mqtt_client.loop_stop()
+            export.mqtt_client.disconnect()
+
+    results['stand_ins'] = {"mqtt": dict(broker.stats), "http": dict(endpoint.stats)}
+
+    history = []
+    if os.path.exists(resultsfilename):
+        try:
+            with open(resultsfilename, encoding='utf-8') as f:
+                history = json.load(f).get('runs', [])
+        except Exception as err:
+            logging.warning(f"Failed: Loading results: {resultsfilename} {err}")
+
+    previous, changes = compare(results, history, threshold)
+    if previous:
+        print(f"\nCompared with {previous['version']} ({previous['timestamp']}), median per call:")
+        for name, before, after, change, regression in changes:
+            print(f"{name:<16} {before:>10} -> {after:<10} {change:+.1f}%{'  REGRESSION' if regression else ''}")
+
+    if save:
+        history.append(results)
+        with open(resultsfilename, 'w', encoding='utf-8') as f:
+            json.dump({"runs": history}, f, indent=2)
+        print(f"\nResults saved: {resultsfilename}")
+
+    broker.shutdown()
+    endpoint.shutdown()
+    if any(change[4] for change in changes):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+from threading import Thread, Condition
+from collections import deque
+from instrumentation import PUBLISH_SECONDS, EXPORTS_SKIPPED
+from windows import AGGREGATES, WindowAggregator
+
+import logging
+import time
+
+class InverterSnapshot(object):
+    """Point in time copy of an inverter scrape, safe to hand to export threads.
+
+    Exports use the same methods they would on SungrowClient; scrape values are
+    frozen at dispatch time, everything else (register metadata) is delegated.
+    """
+    def __init__(self, inverter, serial=None):
+        self._inverter = inverter
+        self.serial = serial or inverter.getSerialNumber()
+        self.latest_scrape = dict(inverter.latest_scrape)
+        self.inverter_config = dict(inverter.inverter_config)
+        self.client_config = dict(inverter.client_config)
+        self.scrape_time = time.time()
+        # Set on snapshots carrying a closed aggregation window rather than a scrape
+        self.window = None
+
+    def __getattr__(self, name):
+        return getattr(self._inverter, name)
+
+    def validateLatestScrape(self, check_register):
+        return check_register in self.latest_scrape
+
+    def getRegisterValue(self, check_register):
+        return self.latest_scrape.get(check_register, False)
+
+    def getInverterModel(self, clean=False):
+        if clean:
+            return self.inverter_config['model'].replace('.','').replace('-','')
+        else:
+            return self.inverter_config['model']
+
+    def getSerialNumber(self):
+        return self.inverter_config['serial_number']
+
+    def windowed(self, window, aggregate):
+        """Copy with the window's aggregate as the scrape, timed at the end of the window"""
+        snapshot = object.__new__(InverterSnapshot)
+        snapshot.__dict__.update(self.__dict__)
+        snapshot.latest_scrape = window.values[aggregate]
+        snapshot.scrape_time = window.end
+        snapshot.window = window
+        return snapshot
+
+
+class ExportWorker(Thread):
+    """Runs one export's publish() on its own thread, fed from a bounded queue"""
+
+    OVERFLOW_POLICIES = ("drop_oldest", "coalesce_latest")
+
+    def __init__(self, name, export, queue_size=10, overflow="drop_oldest", serial=None, window=None, aggregate="mean"):
+        super().__init__(name=f"export-{name}", daemon=True)
+        if overflow not in self.OVERFLOW_POLICIES:
+            logging.warning(f"Dispatcher: {name}: Unknown overflow policy {overflow}, Valid options are: {', '.join(self.OVERFLOW_POLICIES)}. Using drop_oldest")
+            overflow = "drop_oldest"
+        if aggregate not in AGGREGATES:
+            logging.warning(f"Dispatcher: {name}: Unknown aggregate {aggregate}, Valid options are: {', '.join(AGGREGATES)}. Using mean")
+            aggregate = "mean"
+        self.export_name = name
+        self.export = export
+        self.serial = serial
+        # Seconds per aggregation window, None publishes every scrape
+        self.window = int(window) if window else None
+        self.aggregate = aggregate
+        self.overflow = overflow
+        self.queue_size = max(1, int(queue_size))
+        self.queue = deque()
+        self.condition = Condition()
+        self.running = True
+        self.busy = False
+        self.stats = {
+            "depth": 0,
+            "max_depth": 0,
+            "queued": 0,
+            "published": 0,
+            "failed": 0,
+            "dropped": 0,
+            "coalesced": 0,
+            "last_duration": 0.0,
+            "max_duration": 0.0
+        }
+
+    def submit(self, snapshot):
+        if self.serial and snapshot.serial != self.serial:
+            return
+        with self.condition:
+            if self.overflow == "coalesce_latest":
+                # Only the newest scrape of each inverter is worth publishing
+                for queued in [queued for queued in self.queue if queued.serial == snapshot.serial]:
+                    self.queue.remove(queued)
+                    self.stats["coalesced"] += 1
+                    EXPORTS_SKIPPED.inc(export=self.export_name, reason="coalesced")
+            if len(self.queue) >= self.queue_size:
+                self.queue.popleft()
+                self.stats["dropped"] += 1
+                EXPORTS_SKIPPED.inc(export=self.export_name, reason="dropped")
+                logging.warning(f"Dispatcher: {self.export_name} is falling behind, dropped oldest queued scrape")
+            self.queue.append(snapshot)
+            self.stats["queued"] += 1
+            self.stats["depth"] = len(self.queue)
+            self.stats["max_depth"] = max(self.stats["max_depth"], self.stats["depth"])
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.queue:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                snapshot = self.queue.popleft()
+                self.stats["depth"] = len(self.queue)
+                self.busy = True
+
+            start = time.perf_counter()
+            try:
+                result = self.export.publish(snapshot)
+            except Exception as err:
+                logging.exception(f"Dispatcher: {self.export_name}: Failed to publish: {err}")
+                result = False
+            duration = time.perf_counter() - start
+            PUBLISH_SECONDS.observe(duration, export=self.export_name)
+            if result is False:
+                EXPORTS_SKIPPED.inc(export=self.export_name, reason="failed")
+
+            with self.condition:
+                self.busy = False
+                self.stats["last_duration"] = round(duration, 4)
+                self.stats["max_duration"] = round(max(self.stats["max_duration"], duration), 4)
+                # Exports return False when they skip or fail, None is treated as success for older exports
+                if result is False:
+                    self.stats["failed"] += 1
+                else:
+                    self.stats["published"] += 1
+                self.condition.notify_all()
+
+    def stop(self, drain=True, timeout=None):
+        with self.condition:
+            if not drain:
+                self.queue.clear()
+                self.stats["depth"] = 0
+            self.running = False
+            self.condition.notify_all()
+        self.join(timeout)
+
+    def wait_idle(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while self.queue or self.busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+
+class ExportDispatcher(object):
+    """Fans scrape snapshots out to each export's worker, so a slow export never delays the next scrape.
+
+    Exports with a window: get one snapshot per closed window instead of every scrape,
+    each window is aggregated once per inverter and shared by every export using it.
+    """
+    def __init__(self):
+        self.workers = []
+        self.aggregators = {}   # (serial, window): WindowAggregator
+
+    def add_export(self, name, export, config, serial=None):
+        # The same export can be loaded once per inverter, keep stats names unique
+        if name in [worker.export_name for worker in self.workers]:
+            name = f"{name}-{serial or len(self.workers)}"
+        worker = ExportWorker(
+            name,
+            export,
+            queue_size=config.get('queue_size', 10),
+            overflow=config.get('overflow', "drop_oldest"),
+            serial=serial,
+            # Exports can ask for a window (PVOutput uses its status interval), config overrides it
+            window=config.get('window', getattr(export, 'window', None)),
+            aggregate=config.get('aggregate', getattr(export, 'aggregate', "mean"))
+        )
+        worker.start()
+        self.workers.append(worker)
+        logging.info(f"Dispatcher: {name}: queue_size {worker.queue_size}, overflow {worker.overflow}" + (f", inverter {serial}" if serial else "") + (f", {worker.window}s {worker.aggregate} windows" if worker.window else ""))
+        return worker
+
+    def dispatch(self, inverter, serial=None):
+        snapshot = InverterSnapshot(inverter, serial)
+        closed = {}
+        for worker in self.workers:
+            if not worker.window:
+                worker.submit(snapshot)
+                continue
+            if worker.serial and snapshot.serial != worker.serial:
+                continue
+            if worker.window not in closed:
+                aggregator = self.aggregators.get((snapshot.serial, worker.window))
+                if aggregator is None:
+                    aggregator = self.aggregators[(snapshot.serial, worker.window)] = WindowAggregator(worker.window)
+                closed[worker.window] = aggregator.add(snapshot.scrape_time, snapshot.latest_scrape)
+            if closed[worker.window]:
+                worker.submit(snapshot.windowed(closed[worker.window], worker.aggregate))
+        return snapshot
+
+    def stats(self):
+        stats = {}
+        for worker in self.workers:
+            with worker.condition:
+                stats[worker.export_name] = dict(worker.stats)
+        return stats
+
+    def wait_idle(self, timeout=None):
+        return all(worker.wait_idle(timeout) for worker in self.workers)
+
+    def stop(self, drain=True, timeout=30):
+        for worker in self.workers:
+            worker.stop(drain, timeout)
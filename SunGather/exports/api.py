@@ -1,41 +1,299 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from instrumentation import REGISTRY
+from exposition import accepts_openmetrics, CONTENT_TYPE_TEXT, CONTENT_TYPE_OPENMETRICS
+from timeseries import TimeSeriesBuffer, downsample
+from historystore import HistoryStore
 from threading import Thread
 import uvicorn
 import logging
 import json
+import gzip
+import math
+import time
 import asyncio
-from datetime import datetime, timedelta
+from datetime import datetime
 from typing import Dict, List, Optional
 from collections import deque
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+_MISSING = object()
+
+def _encode(message, encoding="json"):
+    """Serialize a WebSocket message, msgpack frames are binary"""
+    if encoding == "msgpack":
+        return msgpack.packb(message)
+    return json.dumps(message)
+
+def _dumps(content):
+    """JSON bytes, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def _content_encoding(accept_encoding):
+    """Best compression the client accepts, brotli when it is installed, otherwise gzip"""
+    accepted = [coding.split(";")[0].strip() for coding in (accept_encoding or "").split(",")]
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return None
+
+class WebSocketClient(object):
+    """One WebSocket connection with a bounded queue of outgoing messages.
+
+    Messages are sent by the client's own task on the server loop, so a slow client
+    never holds up the others or the scrape. When the queue is full the oldest
+    update is dropped (every update holds all registers, the latest supersedes it),
+    a client that does not accept a message within send_timeout is disconnected.
+
+    A client in delta mode only receives the registers it subscribed to, and only
+    when they change. Deltas cannot be dropped, a client that falls behind gets a
+    new snapshot instead.
+    """
+    def __init__(self, websocket, queue_size=8, send_timeout=10):
+        self.websocket = websocket
+        # A snapshot is two messages (meta and values), the queue always has room for both
+        self.queue = asyncio.Queue(maxsize=max(int(queue_size), 2))
+        self.send_timeout = send_timeout
+        self.coalesced = 0
+        # Subscription: registers (None for all), mode (full or delta) and encoding (json or msgpack)
+        self.registers = None
+        self.mode = "full"
+        self.encoding = "json"
+        self.described = set()
+        self.sender = asyncio.get_running_loop().create_task(self._send_loop())
+
+    def subscribe(self, registers=None, mode="full", encoding="json"):
+        if mode not in ("full", "delta"):
+            raise ValueError(f"Unknown mode {mode}, expected full or delta")
+        if encoding not in ("json", "msgpack"):
+            raise ValueError(f"Unknown encoding {encoding}, expected json or msgpack")
+        if encoding == "msgpack" and msgpack is None:
+            raise ValueError("msgpack encoding needs the msgpack package")
+        if isinstance(registers, str):
+            registers = [register for register in registers.split(",") if register]
+        self.registers = frozenset(registers) if registers else None
+        self.mode = mode
+        self.encoding = encoding
+        self.described = set()
+
+    def key(self):
+        """Clients with the same key receive the same bytes"""
+        return (self.registers, self.mode, self.encoding)
+
+    def wanted(self, registers):
+        if self.registers is None:
+            return registers
+        return {register: value for register, value in registers.items() if register in self.registers}
+
+    def room(self):
+        return self.queue.maxsize - self.queue.qsize()
+
+    def send_snapshot(self, serial, seq, timestamp, values, meta):
+        """Replace anything queued with the subscribed registers' metadata and current values"""
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        values = self.wanted(values)
+        self.described = set(values)
+        self.queue.put_nowait(_encode({
+            "type": "meta",
+            "serial": serial,
+            "registers": {register: {"unit": meta[register][0], "address": meta[register][1]} for register in values if register in meta}
+        }, self.encoding))
+        self.queue.put_nowait(_encode({"type": "snapshot", "serial": serial, "seq": seq, "timestamp": timestamp, "registers": values}, self.encoding))
+
+    def enqueue(self, message):
+        """Queue a serialized message, must be called on the server loop"""
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.coalesced += 1
+        self.queue.put_nowait(message)
+
+    async def _send_loop(self):
+        try:
+            while True:
+                message = await self.queue.get()
+                send = self.websocket.send_bytes if isinstance(message, bytes) else self.websocket.send_text
+                await asyncio.wait_for(send(message), self.send_timeout)
+        except asyncio.CancelledError:
+            pass
+        except asyncio.TimeoutError:
+            logging.warning("API: WebSocket client too slow, disconnecting")
+            await self.close()
+        except Exception as e:
+            logging.warning(f"API: Failed to send to WebSocket client: {e}")
+            await self.close()
+
+    async def close(self):
+        try:
+            await self.websocket.close(code=1013)
+        except Exception:
+            pass
+
+
+class EventStream(object):
+    """Numbered Server-Sent Events of one inverter, the latest are kept so clients can resume.
+    Only used on the server loop.
+    """
+    def __init__(self, size=360):
+        self.events = deque(maxlen=max(int(size), 1))    # (seq, frame)
+        self.waiters = set()
+
+    def append(self, seq, frame):
+        self.events.append((seq, frame))
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters.clear()
+
+    def since(self, seq):
+        """Frames after seq, None when some of them are no longer kept"""
+        if not self.events or seq >= self.events[-1][0]:
+            return []
+        if seq < self.events[0][0] - 1:
+            return None
+        return [frame for event_seq, frame in self.events if event_seq > seq]
+
+    async def wait(self, timeout):
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            self.waiters.discard(waiter)
+
+
 class export_api(object):
     """FastAPI-based REST API and WebSocket server for modern web dashboard"""
     
-    # Class-level storage for latest data
-    latest_data = {
-        "registers": {},
-        "config": {},
-        "timestamp": None,
-        "status": "initializing"
-    }
-    
-    # Historical data storage (in-memory, limited size)
-    history_data = deque(maxlen=1440)  # 24 hours at 1min intervals
-    
-    # Active WebSocket connections
-    active_connections: List[WebSocket] = []
+    # Class-level storage per inverter serial number, see _state()
+    inverters: Dict[str, dict] = {}
+
+    # Serial number of the primary inverter, served by the routes without /inverters/{serial}
+    primary = None
+
+    # History kept per inverter, points (scrapes) and registers (None for all)
+    history_size = 1440
+    history_registers = None
+    # HistoryStore when history is kept on disk (history_database)
+    history_store = None
+
+    # uvicorn's event loop, WebSocket messages are only sent from it
+    loop = None
+    ws_queue_size = 8
+    ws_send_timeout = 10
+
+    # Compress JSON responses, and the start of this process so ETags differ between restarts
+    compress = True
+    started = format(int(time.time()), "x")
+
+    # Server-Sent Events kept per inverter for Last-Event-ID resume, and keep-alive interval
+    stream_history = 360
+    stream_keepalive = 15
     
     def __init__(self):
         self.app = None
         self.server = None
+
+    @staticmethod
+    def _state(serial):
+        """Get (or create) the latest data, history and WebSocket clients of one inverter"""
+        if serial not in export_api.inverters:
+            export_api.inverters[serial] = {
+                # Latest data
+                "latest_data": {
+                    "registers": {},
+                    "config": {},
+                    "timestamp": None,
+                    "status": "initializing"
+                },
+                # Historical data storage (on disk when configured, otherwise in-memory columnar ring buffer, limited size)
+                "history_data": export_api.history_store.view(serial) if export_api.history_store else TimeSeriesBuffer(export_api.history_size, export_api.history_registers),
+                # Latest values and (unit, address) of each register, and scrape sequence number, for WebSocket deltas
+                "values": {},
+                "meta": {},
+                "seq": 0,
+                # Serialized (and compressed) responses of the latest scrape, see _cached()
+                "responses": {},
+                # Server-Sent Events, see get_stream()
+                "stream": EventStream(export_api.stream_history),
+                # Active WebSocket connections
+                "active_connections": []
+            }
+        return export_api.inverters[serial]
+
+    @staticmethod
+    def _cached(request, state, kind, build):
+        """Response of one view of the latest scrape.
+
+        The view is serialized (and compressed) once per scrape and shared by every
+        request, clients sending the ETag back in If-None-Match get a 304.
+        """
+        seq = state["seq"]
+        entry = state["responses"].get(kind)
+        if entry is None or entry["seq"] != seq:
+            entry = state["responses"][kind] = {"seq": seq, "body": _dumps(build()), "encoded": {}}
+
+        encoding = _content_encoding(request.headers.get('accept-encoding')) if export_api.compress and len(entry["body"]) > 512 else None
+        etag = f'"{export_api.started}-{seq}-{kind}' + (f'-{encoding}"' if encoding else '"')
+        headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match and (etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'):
+            return Response(status_code=304, headers=headers)
+
+        body = entry["body"]
+        if encoding:
+            if encoding not in entry["encoded"]:
+                entry["encoded"][encoding] = brotli.compress(body, quality=5) if encoding == "br" else gzip.compress(body, compresslevel=6)
+            body = entry["encoded"][encoding]
+            headers["Content-Encoding"] = encoding
+        return Response(body, media_type="application/json", headers=headers)
+
+    @staticmethod
+    def _lookup(serial=None):
+        """Get the state of an inverter for a route, 404 if it is unknown"""
+        if serial is None:
+            serial = export_api.primary
+        if serial not in export_api.inverters:
+            raise HTTPException(status_code=404, detail="Inverter not found")
+        return export_api.inverters[serial]
         
     def configure(self, config, inverter):
         """Configure and start FastAPI server"""
         try:
             port = config.get('port', 8000)
             host = config.get('host', '0.0.0.0')
+            export_api.history_size = config.get('history_size', 1440)
+            export_api.history_registers = config.get('history_registers', None)
+            export_api.ws_queue_size = config.get('ws_queue_size', 8)
+            export_api.ws_send_timeout = config.get('ws_send_timeout', 10)
+            export_api.compress = config.get('compress', True)
+            export_api.stream_history = config.get('stream_history', 360)
+            if config.get('history_database') and export_api.history_store is None:
+                export_api.history_store = HistoryStore(
+                    config.get('history_database'),
+                    retention_days=config.get('history_retention', 365),
+                    raw_days=config.get('history_raw_days', 7),
+                    step=config.get('history_rollup', 300),
+                    registers=export_api.history_registers
+                )
             
             # Create FastAPI app
             self.app = FastAPI(
@@ -57,9 +315,11 @@ class export_api(object):
             
             # Register routes
             self._register_routes()
+            self.app.add_event_handler("startup", self._on_startup)
             
             # Store initial config
-            export_api.latest_data["config"] = {
+            export_api.primary = inverter.getSerialNumber()
+            export_api._state(export_api.primary)["latest_data"]["config"] = {
                 "inverter": inverter.inverter_config,
                 "client": inverter.client_config
             }
@@ -81,78 +341,110 @@ class export_api(object):
             logging.error(f"API: Configuration error: {err}")
             return False
     
+    def _send_initial(self, client, serial, state):
+        """First message(s) of a subscription, runs on the server loop"""
+        if client.mode == "delta":
+            client.send_snapshot(serial, state["seq"], state["latest_data"]["timestamp"], state["values"], state["meta"])
+        elif client.registers is None:
+            client.enqueue(_encode({"type": "initial", "data": state["latest_data"]}, client.encoding))
+        else:
+            client.enqueue(_encode({"type": "initial", "data": dict(state["latest_data"], registers=client.wanted(state["latest_data"]["registers"]))}, client.encoding))
+
+    async def _on_startup(self):
+        export_api.loop = asyncio.get_running_loop()
+
     def _run_server(self, host: str, port: int):
         """Run uvicorn server"""
         uvicorn.run(self.app, host=host, port=port, log_level="warning")
     
     def _register_routes(self):
-        """Register all API routes"""
+        """Register all API routes
         
-        @self.app.get("/api/v1/status")
-        async def get_status():
+        Every inverter route is available as /api/v1/... for the primary inverter
+        and as /api/v1/inverters/{serial}/... for any polled inverter.
+        """
+
+        async def get_status(request: Request, serial: Optional[str] = None):
             """Get current system status"""
-            return JSONResponse({
-                "status": export_api.latest_data["status"],
-                "timestamp": export_api.latest_data["timestamp"],
-                "registers_count": len(export_api.latest_data["registers"]),
-                "history_points": len(export_api.history_data)
+            state = export_api._lookup(serial)
+            return export_api._cached(request, state, "status", lambda: {
+                "status": state["latest_data"]["status"],
+                "timestamp": state["latest_data"]["timestamp"],
+                "registers_count": len(state["latest_data"]["registers"]),
+                "history_points": len(state["history_data"]),
+                "history_bytes": state["history_data"].nbytes()
             })
         
-        @self.app.get("/api/v1/registers")
-        async def get_all_registers():
+        async def get_all_registers(request: Request, serial: Optional[str] = None):
             """Get all current register values"""
-            return JSONResponse(export_api.latest_data["registers"])
+            state = export_api._lookup(serial)
+            return export_api._cached(request, state, "registers", lambda: state["latest_data"]["registers"])
         
-        @self.app.get("/api/v1/registers/{register_name}")
-        async def get_register(register_name: str):
+        async def get_register(request: Request, register_name: str, serial: Optional[str] = None):
             """Get specific register value"""
-            registers = export_api.latest_data["registers"]
+            state = export_api._lookup(serial)
+            registers = state["latest_data"]["registers"]
             if register_name not in registers:
                 raise HTTPException(status_code=404, detail="Register not found")
-            return JSONResponse({
+            return export_api._cached(request, state, f"register-{register_name}", lambda: {
                 "name": register_name,
                 "value": registers[register_name]["value"],
                 "unit": registers[register_name]["unit"],
                 "address": registers[register_name]["address"],
-                "timestamp": export_api.latest_data["timestamp"]
+                "timestamp": state["latest_data"]["timestamp"]
             })
         
-        @self.app.get("/api/v1/config")
-        async def get_config():
+        async def get_config(request: Request, serial: Optional[str] = None):
             """Get current configuration"""
-            return JSONResponse(export_api.latest_data["config"])
+            state = export_api._lookup(serial)
+            return export_api._cached(request, state, "config", lambda: state["latest_data"]["config"])
         
-        @self.app.get("/api/v1/history/daily")
-        async def get_daily_history(
+        # Not async, history on disk is read on the thread pool rather than blocking the event loop
+        def get_daily_history(
             hours: Optional[int] = 24,
-            register: Optional[str] = "total_active_power"
+            register: Optional[str] = "total_active_power",
+            step: Optional[float] = None,
+            max_points: Optional[int] = None,
+            method: Optional[str] = "avg",
+            serial: Optional[str] = None
         ):
-            """Get historical data for specified register"""
-            cutoff_time = datetime.now() - timedelta(hours=hours)
+            """Get historical data for specified register
             
-            filtered_data = [
-                point for point in export_api.history_data
-                if datetime.fromisoformat(point["timestamp"]) > cutoff_time
-                and register in point["registers"]
-            ]
+            step (seconds) or max_points reduce the points returned, method is avg, min, max, last or lttb
+            """
+            if step is not None and not (step > 0 and math.isfinite(step)):
+                raise HTTPException(status_code=400, detail="step must be a positive number of seconds")
+            if max_points is not None and max_points < 1:
+                raise HTTPException(status_code=400, detail="max_points must be at least 1")
+            if method == "lttb" and max_points is not None and max_points < 3:
+                raise HTTPException(status_code=400, detail="max_points must be at least 3 for lttb")
+            timestamps, values = export_api._lookup(serial)["history_data"].series(register, time.time() - hours * 3600, method=method)
+            try:
+                timestamps, values = downsample(timestamps, values, step, max_points, method)
+            except ValueError as err:
+                raise HTTPException(status_code=400, detail=str(err))
             
             return JSONResponse({
                 "register": register,
                 "hours": hours,
-                "data_points": len(filtered_data),
+                "method": method if step or max_points else None,
+                "data_points": len(values),
                 "data": [
                     {
-                        "timestamp": point["timestamp"],
-                        "value": point["registers"][register]["value"]
+                        "timestamp": datetime.fromtimestamp(timestamp).isoformat(),
+                        "value": value
                     }
-                    for point in filtered_data
+                    for timestamp, value in zip(timestamps, values)
                 ]
             })
         
-        @self.app.get("/api/v1/summary")
-        async def get_summary():
+        async def get_summary(request: Request, serial: Optional[str] = None):
             """Get dashboard summary with key metrics"""
-            registers = export_api.latest_data["registers"]
+            state = export_api._lookup(serial)
+            return export_api._cached(request, state, "summary", lambda: build_summary(state))
+
+        def build_summary(state):
+            registers = state["latest_data"]["registers"]
             
             # Extract key metrics (with fallbacks)
             summary = {
@@ -176,71 +468,204 @@ class export_api(object):
                 },
                 "temperature": registers.get("internal_temperature", {}).get("value", None),
                 "status": registers.get("run_state", {}).get("value", "unknown"),
-                "timestamp": export_api.latest_data["timestamp"]
+                "timestamp": state["latest_data"]["timestamp"]
             }
             
-            return JSONResponse(summary)
+            return summary
         
-        @self.app.websocket("/api/v1/ws")
-        async def websocket_endpoint(websocket: WebSocket):
-            """WebSocket endpoint for real-time updates"""
+        async def websocket_endpoint(
+            websocket: WebSocket,
+            serial: Optional[str] = None,
+            registers: Optional[str] = None,
+            mode: Optional[str] = "full",
+            encoding: Optional[str] = "json"
+        ):
+            """WebSocket endpoint for real-time updates
+            
+            mode=delta sends the registers' metadata and values once, then only changed values.
+            registers= (comma separated) limits the registers sent, encoding=msgpack sends binary frames.
+            The subscription can be changed with a {"type": "subscribe", "registers", "mode", "encoding"} message.
+            """
+            serial = serial if serial else export_api.primary
+            state = export_api.inverters.get(serial)
+            if state is None:
+                await websocket.close(code=1008)
+                return
             await websocket.accept()
-            export_api.active_connections.append(websocket)
+            client = WebSocketClient(websocket, export_api.ws_queue_size, export_api.ws_send_timeout)
             
             try:
-                # Send initial data
-                await websocket.send_json({
-                    "type": "initial",
-                    "data": export_api.latest_data
-                })
+                try:
+                    client.subscribe(registers, mode, encoding)
+                except ValueError as err:
+                    await websocket.send_text(json.dumps({"type": "error", "detail": str(err)}))
+                    await websocket.close(code=1008)
+                    return
+                state["active_connections"].append(client)
+                self._send_initial(client, serial, state)
                 
                 # Keep connection alive
                 while True:
-                    # Wait for client messages (ping/pong)
+                    # Wait for client messages (ping/pong, subscribe)
                     data = await websocket.receive_text()
                     if data == "ping":
-                        await websocket.send_text("pong")
+                        client.enqueue("pong")
+                    elif data.startswith("{"):
+                        # A malformed message is answered with an error, the connection stays open
+                        try:
+                            request = json.loads(data)
+                            if request.get("type") != "subscribe":
+                                continue
+                            client.subscribe(request.get("registers"), request.get("mode", "full"), request.get("encoding", "json"))
+                        except (ValueError, TypeError) as err:
+                            client.enqueue(json.dumps({"type": "error", "detail": str(err)}))
+                            continue
+                        self._send_initial(client, serial, state)
                         
             except WebSocketDisconnect:
-                export_api.active_connections.remove(websocket)
                 logging.info("API: WebSocket client disconnected")
             except Exception as e:
                 logging.error(f"API: WebSocket error: {e}")
-                if websocket in export_api.active_connections:
-                    export_api.active_connections.remove(websocket)
+            finally:
+                client.sender.cancel()
+                if client in state["active_connections"]:
+                    state["active_connections"].remove(client)
+
+        async def get_stream(request: Request, serial: Optional[str] = None, last_event_id: Optional[str] = None):
+            """Server-Sent Events, a snapshot then one numbered delta event per scrape
+            
+            A client reconnecting with Last-Event-ID only gets the deltas it missed, or a new
+            snapshot when they are no longer kept.
+            """
+            serial = serial if serial else export_api.primary
+            state = export_api._lookup(serial)
+            stream = state["stream"]
+            last_event_id = request.headers.get('last-event-id', last_event_id)
+
+            # Event ids are <process start>-<scrape sequence number>, ids of an earlier process can't be resumed
+            frames = None
+            if last_event_id and last_event_id.startswith(f"{export_api.started}-"):
+                try:
+                    seq = int(last_event_id.split("-", 1)[1])
+                    frames = stream.since(seq) if seq <= state["seq"] else None
+                except ValueError:
+                    pass
+            if frames is None:
+                seq = state["seq"]
+                meta = state["meta"]
+                frames = [
+                    f"retry: 5000\nevent: meta\ndata: {_dumps({'serial': serial, 'registers': {register: {'unit': unit, 'address': address} for register, (unit, address) in meta.items()}}).decode()}\n\n",
+                    f"id: {export_api.started}-{seq}\nevent: snapshot\ndata: {_dumps({'serial': serial, 'seq': seq, 'timestamp': state['latest_data']['timestamp'], 'registers': state['values']}).decode()}\n\n"
+                ]
+            elif frames:
+                seq = stream.events[-1][0]
+
+            async def events(frames, seq):
+                while True:
+                    for frame in frames:
+                        yield frame
+                    await stream.wait(export_api.stream_keepalive)
+                    if await request.is_disconnected():
+                        break
+                    frames = stream.since(seq)
+                    if frames is None:
+                        # Fell too far behind, should not happen while connected
+                        break
+                    if frames:
+                        seq = stream.events[-1][0]
+                    else:
+                        frames = [": keep-alive\n\n"]
+
+            return StreamingResponse(events(frames, seq), media_type="text/event-stream", headers={
+                "Cache-Control": "no-cache",
+                # Stop nginx buffering the stream
+                "X-Accel-Buffering": "no"
+            })
+
+        @self.app.get("/api/v1/inverters")
+        async def get_inverters():
+            """List polled inverters"""
+            return JSONResponse([
+                {
+                    "serial": serial,
+                    "model": state["latest_data"]["config"].get("inverter", {}).get("model"),
+                    "primary": serial == export_api.primary,
+                    "status": state["latest_data"]["status"],
+                    "timestamp": state["latest_data"]["timestamp"]
+                }
+                for serial, state in export_api.inverters.items()
+            ])
+
+        @self.app.get("/api/v1/metrics")
+        async def get_metrics(request: Request, format: Optional[str] = None):
+            """Scrape, block read and export timings, Prometheus text, OpenMetrics or JSON with ?format=json"""
+            if format == "json":
+                return JSONResponse(REGISTRY.snapshot())
+            if accepts_openmetrics(request.headers.get('accept')):
+                return Response(REGISTRY.render(True) + "# EOF\n", media_type=CONTENT_TYPE_OPENMETRICS)
+            return Response(REGISTRY.render(), media_type=CONTENT_TYPE_TEXT)
+
+        for prefix in ("/api/v1", "/api/v1/inverters/{serial}"):
+            self.app.add_api_route(f"{prefix}/status", get_status, methods=["GET"])
+            self.app.add_api_route(f"{prefix}/registers", get_all_registers, methods=["GET"])
+            self.app.add_api_route(f"{prefix}/registers/{{register_name}}", get_register, methods=["GET"])
+            self.app.add_api_route(f"{prefix}/config", get_config, methods=["GET"])
+            self.app.add_api_route(f"{prefix}/history/daily", get_daily_history, methods=["GET"])
+            self.app.add_api_route(f"{prefix}/summary", get_summary, methods=["GET"])
+            self.app.add_api_websocket_route(f"{prefix}/ws", websocket_endpoint)
+            self.app.add_api_route(f"{prefix}/stream", get_stream, methods=["GET"])
     
     def publish(self, inverter):
         """Called when new data is scraped from inverter"""
         try:
+            state = export_api._state(inverter.getSerialNumber())
+
             # Prepare register data
             registers_data = {}
+            meta = {}
             for register, value in inverter.latest_scrape.items():
                 registers_data[register] = {
                     "value": value,
                     "unit": inverter.getRegisterUnit(register),
                     "address": inverter.getRegisterAddress(register)
                 }
+                meta[register] = (registers_data[register]["unit"], registers_data[register]["address"])
             
             # Update latest data
-            export_api.latest_data["registers"] = registers_data
-            export_api.latest_data["timestamp"] = datetime.now().isoformat()
-            export_api.latest_data["status"] = "healthy"
+            state["latest_data"]["registers"] = registers_data
+            state["latest_data"]["config"] = {
+                "inverter": inverter.inverter_config,
+                "client": inverter.client_config
+            }
+            state["latest_data"]["timestamp"] = datetime.now().isoformat()
+            state["latest_data"]["status"] = "healthy"
             
-            # Add to history
-            export_api.history_data.append({
-                "timestamp": export_api.latest_data["timestamp"],
-                "registers": registers_data
-            })
+            # Add to history, one value per register, unit and address are only stored the first time
+            state["history_data"].append(getattr(inverter, 'scrape_time', time.time()), inverter.latest_scrape, meta)
+
+            # Changed registers since the previous scrape, for WebSocket deltas
+            values = dict(inverter.latest_scrape)
+            changed = {register: value for register, value in values.items() if state["values"].get(register, _MISSING) != value}
+            state["values"] = values
+            state["meta"] = meta
+            state["seq"] += 1
+
+            # Server-Sent Event of the changes, numbered by the scrape sequence number
+            frame = f"id: {export_api.started}-{state['seq']}\nevent: delta\ndata: {_dumps({'serial': inverter.getSerialNumber(), 'seq': state['seq'], 'timestamp': state['latest_data']['timestamp'], 'registers': changed}).decode()}\n\n"
+            if export_api.loop:
+                export_api.loop.call_soon_threadsafe(state["stream"].append, state["seq"], frame)
             
-            # Broadcast to WebSocket clients
-            if export_api.active_connections:
-                asyncio.run(self._broadcast_update({
-                    "type": "update",
-                    "data": {
-                        "registers": registers_data,
-                        "timestamp": export_api.latest_data["timestamp"]
-                    }
-                }))
+            # Broadcast to WebSocket clients, serialized once and queued on the server loop
+            if state["active_connections"] and export_api.loop:
+                export_api.loop.call_soon_threadsafe(self._broadcast_update, state["active_connections"], {
+                    "serial": inverter.getSerialNumber(),
+                    "seq": state["seq"],
+                    "timestamp": state["latest_data"]["timestamp"],
+                    "registers": registers_data,
+                    "values": values,
+                    "meta": meta,
+                    "changed": changed
+                })
             
             return True
             
@@ -248,17 +673,36 @@ class export_api(object):
             logging.error(f"API: Publish error: {err}")
             return False
     
-    async def _broadcast_update(self, message: dict):
-        """Broadcast message to all connected WebSocket clients"""
-        disconnected = []
-        
-        for connection in export_api.active_connections:
-            try:
-                await connection.send_json(message)
-            except Exception as e:
-                logging.warning(f"API: Failed to send to WebSocket client: {e}")
-                disconnected.append(connection)
-        
-        # Remove disconnected clients
-        for connection in disconnected:
-            export_api.active_connections.remove(connection)
+    def _broadcast_update(self, connections: List[WebSocketClient], update: dict):
+        """Queue a scrape for every connected WebSocket client, runs on the server loop.
+        Each message is serialized once for all clients with the same subscription.
+        """
+        messages = {}
+        for client in list(connections):
+            if client.mode == "delta":
+                changed = client.wanted(update["changed"])
+                new = [register for register in changed if register not in client.described]
+                if client.room() < bool(changed) + bool(new):
+                    # Metadata and delta are queued together or not at all, a dropped delta would lose changes,
+                    # so the client starts again from the current values
+                    client.coalesced += 1
+                    client.send_snapshot(update["serial"], update["seq"], update["timestamp"], update["values"], update["meta"])
+                    continue
+                if new:
+                    client.described.update(new)
+                    client.enqueue(_encode({
+                        "type": "meta",
+                        "serial": update["serial"],
+                        "registers": {register: {"unit": update["meta"][register][0], "address": update["meta"][register][1]} for register in new if register in update["meta"]}
+                    }, client.encoding))
+                if not changed:
+                    continue
+
+            key = client.key()
+            if key not in messages:
+                if client.mode == "delta":
+                    message = {"type": "delta", "serial": update["serial"], "seq": update["seq"], "timestamp": update["timestamp"], "registers": changed}
+                else:
+                    message = {"type": "update", "data": {"serial": update["serial"], "registers": client.wanted(update["registers"]), "timestamp": update["timestamp"]}}
+                messages[key] = _encode(message, client.encoding)
+            client.enqueue(messages[key])
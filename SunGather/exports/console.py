@@ -24,6 +24,6 @@ class export_console(object):
         for register, value in inverter.latest_scrape.items():
             print("| {:<7} | {:<35} | {:<20} |".format(str(inverter.getRegisterAddress(register)), str(register), str(value) + " " + str(inverter.getRegisterUnit(register))))
         print("+----------------------------------------------------------------------+") 
-        print(f"Logged {len(inverter.latest_scrape)} registers to Console")
+        print(f"Logged {len(inverter.latest_scrape)} registers from {inverter.getSerialNumber()} to Console")
 
         return True
\ No newline at end of file
@@ -1,11 +1,40 @@
 import influxdb_client
 import logging
+import math
+import time
 from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client.domain.write_precision import WritePrecision
+from influxdb_client.rest import ApiException
+from threading import Event, Thread
+from spool import Spool
+from paths import data_path
+
+# Line protocol escaping, see https://docs.influxdata.com/influxdb/v2/reference/syntax/line-protocol/#special-characters
+def _escape_measurement(name):
+    return str(name).replace('\\', '\\\\').replace(',', '\\,').replace(' ', '\\ ')
+
+def _escape_key(name):
+    return _escape_measurement(name).replace('=', '\\=')
+
+def _field_value(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    value = float(value)
+    return repr(value) if math.isfinite(value) else None
 
 class export_influxdb(object):
     def __init__(self):
         self.client = None
         self.write_api = None
+        # Points (line protocol) waiting to be written, kept until InfluxDB accepts them
+        self.buffer = None
+        self.flush_wanted = Event()
+        self.retry_delay = 0
+        self.retry_at = 0
+        # Per inverter serial number: [(escaped "measurement,tags " prefix, [(register, escaped "field=")])]
+        self.series = {}
 
     # Configure InfluxDB
     def configure(self, config, inverter):
@@ -15,7 +44,13 @@ class export_influxdb(object):
             'username': config.get('username', None),
             'password': config.get('password', None),
             'org': config.get('org',None),
-            'bucket': config.get('bucket',None)
+            'bucket': config.get('bucket',None),
+            # Tagging every point with the serial would start new series for existing single inverter installs
+            'serial_tag': config.get('serial_tag', getattr(self, 'inverter_count', 1) > 1),
+            'batch_size': config.get('batch_size', 1000),
+            'flush_interval': config.get('flush_interval', 10),
+            'max_retry_delay': config.get('max_retry_delay', 300),
+            'gzip': config.get('gzip', True)
         }
         self.influxdb_measurements = [{}]
         self.influxdb_measurements.pop() # Remove null value from list
@@ -29,13 +64,15 @@ class export_influxdb(object):
                 self.client = influxdb_client.InfluxDBClient(
                     url=self.influxdb_config['url'],
                     token=self.influxdb_config['token'],
-                    org=self.influxdb_config['org']
+                    org=self.influxdb_config['org'],
+                    enable_gzip=self.influxdb_config['gzip']
                 )
             elif config.get('username',False) and config.get('password',False):
                 self.client = influxdb_client.InfluxDBClient(
                     url=self.influxdb_config['url'],
                     token=f"{self.influxdb_config['username']}:{self.influxdb_config['password']}",
-                    org=self.influxdb_config['org']
+                    org=self.influxdb_config['org'],
+                    enable_gzip=self.influxdb_config['gzip']
                 )
 
         except Exception as err:
@@ -48,27 +85,85 @@ class export_influxdb(object):
                 continue
             self.influxdb_measurements.append(measurement)
 
+        # Writes are synchronous but only made by the flush thread, publish() just buffers the points
         self.write_api = self.client.write_api(write_options=SYNCHRONOUS)
+        # On disk by default so a crash or restart keeps points not yet written, buffer: False keeps them in memory
+        buffer = config.get('buffer', data_path(f"influxdb-buffer-{inverter.getSerialNumber()}.db"))
+        self.buffer = Spool(buffer or None, config.get('buffer_size', 100000), "InfluxDB")
+        Thread(target=self.flush_loop, name="influxdb-flush", daemon=True).start()
         logging.info(f"InfluxDB: Configured: {self.client.url}")
 
         return True
 
+    def flush_loop(self):
+        """Write buffered points in batches every flush_interval, retry with exponential backoff"""
+        delay = None
+        while True:
+            self.flush_wanted.wait(delay or self.influxdb_config['flush_interval'])
+            self.flush_wanted.clear()
+            delay = None
+            while len(self.buffer):
+                batch = self.buffer.peek(self.influxdb_config['batch_size'])
+                try:
+                    self.write_api.write(self.influxdb_config['bucket'], self.client.org, [line for id, line in batch], write_precision=WritePrecision.MS)
+                except ApiException as err:
+                    if err.status in (400, 422):
+                        # Retrying would fail the same way and hold up every later point
+                        logging.error(f"InfluxDB: Dropped {len(batch)} points rejected by the server: {err.body}")
+                        self.buffer.ack(batch[-1][0])
+                        continue
+                    delay = self.retry(err)
+                    break
+                except Exception as err:
+                    delay = self.retry(err)
+                    break
+                self.buffer.ack(batch[-1][0])
+                self.retry_delay = 0
+                self.retry_at = 0
+                logging.debug(f"InfluxDB: Wrote {len(batch)} points, {len(self.buffer)} buffered")
+
+    def retry(self, err):
+        self.retry_delay = min(max(self.retry_delay * 2, 5), self.influxdb_config['max_retry_delay'])
+        self.retry_at = time.time() + self.retry_delay
+        logging.error(f"InfluxDB: Write failed, {len(self.buffer)} points buffered, retrying in {self.retry_delay} secs: {err}")
+        return self.retry_delay
+
+    def compile(self, inverter):
+        """Line protocol prefix of each configured point, with fields sharing a point in one line"""
+        serial_number = inverter.getSerialNumber()
+        tags = f",inverter={_escape_key(inverter.getInverterModel(True))}"
+        if self.influxdb_config['serial_tag']:
+            tags += f",serial={_escape_key(serial_number)}"
+        points = {}
+        for measurement in self.influxdb_measurements:
+            points.setdefault(measurement['point'], []).append((measurement['register'], f"{_escape_key(measurement['register'])}="))
+        self.series[serial_number] = [(f"{_escape_measurement(point)}{tags} ", fields) for point, fields in points.items()]
+        return self.series[serial_number]
+
     def publish(self, inverter):
         sequence = []
+        # Points carry the scrape time, so buffered points keep it when written later
+        timestamp = f" {int(getattr(inverter, 'scrape_time', time.time()) * 1000)}"
+        latest_scrape = inverter.latest_scrape
 
-        for measurement in self.influxdb_measurements:
-            register = measurement['register']
-            if not inverter.validateLatestScrape(register):
-                logging.error(f"InfluxDB: Skipped collecting data, {register} missing from last scrape")
-                return False
-            value = inverter.getRegisterValue(register) if type(inverter.getRegisterValue(register)) is str else float(inverter.getRegisterValue(register))
-            sequence.append(influxdb_client.Point(measurement['point']).tag("inverter", inverter.getInverterModel(True)).field(register, value))
+        series = self.series.get(inverter.getSerialNumber()) or self.compile(inverter)
+        for prefix, fields in series:
+            line = []
+            for register, field in fields:
+                if register not in latest_scrape:
+                    logging.error(f"InfluxDB: Skipped collecting data, {register} missing from last scrape")
+                    return False
+                value = _field_value(latest_scrape[register])
+                if value is not None:
+                    line.append(field + value)
+            if line:
+                sequence.append(prefix + ",".join(line) + timestamp)
 
-        try:
-            self.write_api.write(self.influxdb_config['bucket'], self.client.org, sequence)
-        except Exception as err:
-            logging.error("InfluxDB: " + str(err))
+        self.buffer.extend(sequence)
+        # A full batch is written straight away, unless a failed write is backing off
+        if len(self.buffer) >= self.influxdb_config['batch_size'] and time.time() >= self.retry_at:
+            self.flush_wanted.set()
 
-        logging.info("InfluxDB: Published")
+        logging.info(f"InfluxDB: Published, {len(self.buffer)} points buffered")
 
         return True
@@ -1,13 +1,31 @@
 import logging
 import json
+import time
 import paho.mqtt.client as mqtt
+from threading import Event, Lock, Thread
+from spool import Spool
 
 class export_mqtt(object):
     def __init__(self):
         self.mqtt_client = None
         self.sensor_topic = None
-        self.mqtt_queue = []
-        self.ha_discovery_published = False
+        # Messages handed to paho and not yet published (QoS 0) or acknowledged (QoS 1), by mid
+        self.inflight = {}
+        # mids acknowledged before publish() returned, so they are not added to inflight afterwards
+        self.acked = set()
+        # Messages waiting for the broker, replayed in order once connected
+        self.spool = None
+        # Retained topics published live while older messages were spooled, their spooled messages are out of date
+        self.superseded = set()
+        # lock orders spooling and publishing, inflight_lock guards inflight and acked. paho calls on_publish
+        # holding its own locks, so inflight_lock is never held while calling paho
+        self.lock = Lock()
+        self.inflight_lock = Lock()
+        self.replay_wanted = Event()
+        self.ha_discovery_published = []
+        # Registers mode, per inverter: {register: (value, time)} last published, and whether config was published
+        self.published_values = {}
+        self.config_published = []
         # Exclude ones linked to register lookups; unit_of_measurement
         self.ha_variables = ["action_topic", "action_template", "automation_type", "aux_command_topic", "aux_state_template", "aux_state_topic", "available_tones", "availability", "availability_mode", "availability_topic", "availability_template", "away_mode_command_topic", "away_mode_state_template", "away_mode_state_topic", "blue_template", "brightness_command_topic", "brightness_command_template", "brightness_scale", "brightness_state_topic", "brightness_template", "brightness_value_template", "color_temp_command_template", "battery_level_topic", "battery_level_template", "charging_topic", "charging_template", "color_temp_command_topic", "color_temp_state_topic", "color_temp_template", "color_temp_value_template", "color_mode", "color_mode_state_topic", "color_mode_value_template", "cleaning_topic", "cleaning_template", "command_off_template", "command_on_template", "command_topic", "command_template", "code_arm_required", "code_disarm_required", "code_trigger_required", "current_temperature_topic", "current_temperature_template", "device", "device_class", "docked_topic", "docked_template", "encoding", "enabled_by_default", "entity_category", "entity_picture", "error_topic", "error_template", "fan_speed_topic", "fan_speed_template", "fan_speed_list", "flash_time_long", "flash_time_short", "effect_command_topic", "effect_command_template", "effect_list", "effect_state_topic", "effect_template", "effect_value_template", "expire_after", "fan_mode_command_template", "fan_mode_command_topic", "fan_mode_state_template", "fan_mode_state_topic", "force_update", "green_template", "hold_command_template", "hold_command_topic", "hold_state_template", "hold_state_topic", "hs_command_topic", "hs_state_topic", "hs_value_template", "icon", "image_encoding", "initial", "target_humidity_command_topic", "target_humidity_command_template", "target_humidity_state_topic", "target_humidity_state_template", "json_attributes", "json_attributes_topic", "json_attributes_template", "latest_version_topic", "latest_version_template", "last_reset_topic", "last_reset_value_template", "max", "min", "max_mireds", "min_mireds", "max_temp", "min_temp", "max_humidity", "min_humidity", "mode", "mode_command_template", "mode_command_topic", "mode_state_template", "mode_state_topic", "modes", "name", "object_id", "off_delay", "on_command_type", "options", "optimistic", "oscillation_command_topic", "oscillation_command_template", "oscillation_state_topic", "oscillation_value_template", "percentage_command_topic", "percentage_command_template", "percentage_state_topic", "percentage_value_template", "pattern", "payload", "payload_arm_away", "payload_arm_home", "payload_arm_custom_bypass", "payload_arm_night", "payload_arm_vacation", "payload_press", "payload_reset", "payload_available", "payload_clean_spot", "payload_close", "payload_disarm", "payload_home", "payload_install", "payload_lock", "payload_locate", "payload_not_available", "payload_not_home", "payload_off", "payload_on", "payload_open", "payload_oscillation_off", "payload_oscillation_on", "payload_pause", "payload_stop", "payload_start", "payload_start_pause", "payload_return_to_base", "payload_reset_humidity", "payload_reset_mode", "payload_reset_percentage", "payload_reset_preset_mode", "payload_turn_off", "payload_turn_on", "payload_trigger", "payload_unlock", "position_closed", "position_open", "power_command_topic", "power_state_topic", "power_state_template", "preset_mode_command_topic", "preset_mode_command_template", "preset_mode_state_topic", "preset_mode_value_template", "preset_modes", "red_template", "release_summary", "release_url", "retain", "rgb_command_topic", "rgb_command_template", "rgb_state_topic", "rgb_value_template", "rgbw_command_topic", "rgbw_command_template", "rgbw_state_topic", "rgbw_value_template", "rgbww_command_topic", "rgbww_command_template", "rgbww_state_topic", "rgbww_value_template", "send_command_topic", "send_if_off", "set_fan_speed_topic", "set_position_template", "set_position_topic", "position_topic", "position_template", "speed_range_min", "speed_range_max", "source_type", "state_class", "state_closed", "state_closing", "state_off", "state_on", "state_open", "state_opening", "state_stopped", "state_locked", "state_unlocked", "state_topic", "state_template", "state_value_template", "step", "subtype", "supported_color_modes", "support_duration", "support_volume_set", "supported_features", "swing_mode_command_template", "swing_mode_command_topic", "swing_mode_state_template", "swing_mode_state_topic", "temperature_command_template", "temperature_command_topic", "temperature_high_command_template", "temperature_high_command_topic", "temperature_high_state_template", "temperature_high_state_topic", "temperature_low_command_template", "temperature_low_command_topic", "temperature_low_state_template", "temperature_low_state_topic", "temperature_state_template", "temperature_state_topic", "temperature_unit", "tilt_closed_value", "tilt_command_topic", "tilt_command_template", "tilt_invert_state", "tilt_max", "tilt_min", "tilt_opened_value", "tilt_optimistic", "tilt_status_topic", "tilt_status_template", "title", "topic", "unique_id", "value_template", "white_command_topic", "white_scale", "white_value_command_topic", "white_value_scale", "white_value_state_topic", "white_value_template", "xy_command_topic", "xy_state_topic", "xy_value_template"]
 
@@ -20,12 +38,24 @@ class export_mqtt(object):
             'host': config.get('host', None),
             'port': config.get('port', 1883),
             'client_id': config.get('client_id', f'{self.serial_number}'),
-            'topic': config.get('topic', f"SunGather/{self.serial_number}"),
+            'topic': config.get('topic', "SunGather/{serial_number}"),
             'username': config.get('username', None),
             'password': config.get('password',None),
-            'homeassistant': config.get('homeassistant',False)
+            'homeassistant': config.get('homeassistant',False),
+            'mode': config.get('mode', 'json'),
+            'deadband': config.get('deadband', 0),
+            'deadband_pct': config.get('deadband_pct', 0),
+            'deadbands': config.get('deadbands', {}) or {},
+            'heartbeat': config.get('heartbeat', 300),
+            'qos': config.get('qos', 0),
+            'max_inflight': config.get('max_inflight', 1000),
+            'replay_rate': config.get('replay_rate', 50)
         }
 
+        if self.mqtt_config['mode'] not in ('json', 'registers'):
+            logging.error(f"MQTT: Unknown mode {self.mqtt_config['mode']}, expected json or registers")
+            return False
+
         self.ha_sensors = [{}]
         self.ha_sensors.pop() # Remove null value from list
 
@@ -40,6 +70,11 @@ class export_mqtt(object):
         self.mqtt_client.on_connect = self.on_connect
         self.mqtt_client.on_disconnect = self.on_disconnect
         self.mqtt_client.on_publish = self.on_publish
+        # paho queues QoS 1 messages without limit, anything over max_inflight goes to the spool
+        self.mqtt_client.max_queued_messages_set(self.mqtt_config['max_inflight'])
+
+        self.spool = Spool(config.get('spool', None), config.get('spool_size', 10000), "MQTT")
+        Thread(target=self.replay, name="mqtt-replay", daemon=True).start()
 
         if self.mqtt_config['username'] and self.mqtt_config['password']:
             self.mqtt_client.username_pw_set(self.mqtt_config['username'], self.mqtt_config['password'])
@@ -71,10 +106,17 @@ class export_mqtt(object):
     def on_connect(self, client, userdata, flags, reason_code, properties):
         if reason_code == 0:
             logging.info(f"MQTT: Connected to {client._host}:{client._port}")
+            # Retained config is published again, the broker may have restarted without persistence
+            self.config_published = []
+            self.replay_wanted.set()
         if reason_code > 0:
             logging.warn(f"MQTT: FAILED to connect {client._host}:{client._port}")
 
     def on_disconnect(self, client, userdata, flags, reason_code, properties):
+        # QoS 0 messages not yet written are lost, paho sends QoS 1 messages again after reconnecting
+        with self.inflight_lock:
+            self.inflight = {mid: message for mid, message in self.inflight.items() if message['qos'] > 0}
+            self.acked.clear()
         if reason_code == 0:
             logging.info(f"MQTT: Server Disconnected")
         if reason_code > 0:
@@ -82,29 +124,110 @@ class export_mqtt(object):
         
     
     def on_publish(self, client, userdata, mid, reason_codes, properties):
-        try:
-            self.mqtt_queue.remove(mid)
-        except Exception as err:
-            pass
+        with self.inflight_lock:
+            if self.inflight.pop(mid, None) is None:
+                # Acknowledged before _publish() stored it
+                self.acked.add(mid)
+        if len(self.spool):
+            self.replay_wanted.set()
         logging.debug(f"MQTT: Message {mid} Published")
 
+    def _publish(self, message):
+        """Hand a message to paho, False if it was not accepted. Call with self.lock held"""
+        info = self.mqtt_client.publish(message['topic'], message['payload'], qos=message['qos'], retain=message['retain'])
+        # paho keeps QoS 1 messages while disconnected and sends them after reconnecting. A QoS 0 message
+        # without a connection is not kept by paho, so it is left to the spool and only one of them delivers it
+        if info.rc == mqtt.MQTT_ERR_SUCCESS or (message['qos'] > 0 and info.rc == mqtt.MQTT_ERR_NO_CONN):
+            with self.inflight_lock:
+                if info.mid in self.acked:
+                    self.acked.discard(info.mid)
+                else:
+                    self.inflight[info.mid] = message
+            return True
+        return False
+
+    def send(self, topic, payload, qos=None, retain=False):
+        """Publish, or spool the message while the broker is unreachable or busy.
+        New messages are published while the spool is replayed, so a backlog always drains.
+        """
+        message = {'topic': topic, 'payload': payload, 'qos': self.mqtt_config['qos'] if qos is None else qos, 'retain': retain}
+        with self.lock:
+            if self.mqtt_client.is_connected() and len(self.inflight) < self.mqtt_config['max_inflight'] and self._publish(message):
+                if retain and len(self.spool):
+                    self.superseded.add(topic)
+            else:
+                self.spool.put(message)
+                # The spooled message is now the newest for its topic
+                self.superseded.discard(topic)
+
+    def replay(self):
+        """Publish spooled messages in order once connected, replay_rate per second or faster for large backlogs"""
+        batch_size = max(min(int(self.mqtt_config['replay_rate']), 100), 1)
+        while True:
+            self.replay_wanted.wait()
+            self.replay_wanted.clear()
+            while len(self.spool) and self.mqtt_client.is_connected():
+                sent = 0
+                with self.lock:
+                    last_id = None
+                    for id, message in self.spool.peek(batch_size):
+                        if message['retain'] and message['topic'] in self.superseded:
+                            # A newer retained value was published live, replaying this one would overwrite it
+                            last_id = id
+                            continue
+                        if len(self.inflight) >= self.mqtt_config['max_inflight'] or not self._publish(message):
+                            break
+                        last_id = id
+                        sent += 1
+                    if last_id is not None:
+                        self.spool.ack(last_id)
+                    if not len(self.spool):
+                        self.superseded.clear()
+                if not sent:
+                    if last_id is not None:
+                        continue
+                    # Broker busy, on_publish asks again
+                    break
+                logging.debug(f"MQTT: Replayed {sent} messages, {len(self.spool)} waiting")
+                # Large backlogs replay faster, at least a sixtieth of what is waiting every second
+                time.sleep(sent / max(self.mqtt_config['replay_rate'], len(self.spool) / 60))
+
     def cleanName(self, name):
         return name.lower().replace(' ','_')
 
+    def changed(self, register, value, last):
+        """True when value moved further than the register's deadband from the last published value"""
+        if not isinstance(value, (int, float)) or isinstance(value, bool) or not isinstance(last, (int, float)) or isinstance(last, bool):
+            return value != last
+        deadband = self.mqtt_config['deadbands'].get(register, {})
+        absolute = deadband.get('abs', self.mqtt_config['deadband'])
+        percent = deadband.get('pct', self.mqtt_config['deadband_pct'])
+        difference = abs(value - last)
+        if not absolute and not percent:
+            return difference != 0
+        return (absolute and difference > absolute) or (percent and difference > abs(last) * percent / 100)
+
+    def formatTopic(self, topic, inverter):
+        # Topics can include {serial_number} / {model}, needed to keep inverters apart when polling several
+        return topic.replace('{serial_number}', str(inverter.getSerialNumber())).replace('{model}', inverter.getInverterModel(True))
+
     def publish(self, inverter):
         try:
             if not self.mqtt_client.is_connected():
-                logging.warning(f'MQTT: Server Disconnected; {self.mqtt_queue.__len__()} messages queued, will automatically attempt to reconnect')
+                logging.warning(f'MQTT: Server Disconnected; {len(self.spool)} messages queued, will automatically attempt to reconnect')
+            elif len(self.spool) > 10:
+                logging.warning(f'MQTT: {len(self.spool)} messages queued, this may be due to a MQTT server issue')
         except Exception as err:
             logging.warning(f'MQTT: Server Error; Server not configured')
             return False
-        # qos=0 is set, so no acknowledgment is sent, rending this check useless
-        #elif self.mqtt_queue.__len__() > 10:
-        #    logging.warning(f'MQTT: {self.mqtt_queue.__len__()} messages queued, this may be due to a MQTT server issue')
 
-        if self.mqtt_config['homeassistant'] and not self.ha_discovery_published:
+        model = inverter.getInverterModel(True)
+        serial_number = inverter.getSerialNumber()
+        state_topic = self.formatTopic(self.mqtt_config['topic'], inverter)
+
+        if self.mqtt_config['homeassistant'] and serial_number not in self.ha_discovery_published:
             # Build Device, this will be the same for every message
-            ha_device = { "name":f"Sungrow {self.model}", "manufacturer":"Sungrow", "model":self.model, "identifiers":self.serial_number, "via_device": "SunGather", "connections":[["address", inverter.getHost() ]]}
+            ha_device = { "name":f"Sungrow {model}", "manufacturer":"Sungrow", "model":model, "identifiers":serial_number, "via_device": "SunGather", "connections":[["address", inverter.getHost() ]]}
 
             for ha_sensor in self.ha_sensors:
                 config_msg = {}
@@ -113,7 +236,7 @@ class export_mqtt(object):
                     break
 
                 # Set Defaults, these can be overridden below
-                config_msg['state_topic'] = self.mqtt_config['topic']
+                config_msg['state_topic'] = state_topic
                 if ha_sensor.get('register', False):
                     config_msg['value_template'] = "{{ value_json." + ha_sensor.get('register') + " }}"
 
@@ -121,8 +244,17 @@ class export_mqtt(object):
                     if ha_sensor.get(ha_variable):
                         config_msg[ha_variable] = ha_sensor[ha_variable]
 
+                # Registers mode, each register has its own topic with the plain value
+                if self.mqtt_config['mode'] == 'registers' and ha_sensor.get('register', False):
+                    config_msg['state_topic'] = f"{state_topic}/{ha_sensor.get('register')}"
+                    for key in [key for key in config_msg if key.endswith('_template') and 'value_json' in str(config_msg[key])]:
+                        config_msg[key] = config_msg[key].replace(f"value_json.{ha_sensor.get('register')}", "value")
+                        if 'value_json' in config_msg[key]:
+                            logging.warning(f"MQTT: {ha_sensor.get('name')} {key} uses other registers, not available in registers mode")
+                            del config_msg[key]
+
                 # Set unique_id, include Serial so is unique
-                config_msg['unique_id'] = f"sungather_{self.cleanName(config_msg['name'])}_{self.serial_number}"
+                config_msg['unique_id'] = f"sungather_{self.cleanName(config_msg['name'])}_{serial_number}"
 
                 # Variables with links to registers
                 if ha_sensor.get('register', False):
@@ -132,19 +264,48 @@ class export_mqtt(object):
                 config_msg['device'] = ha_device
 
                 # <discovery_prefix>/<component>/<object_id>/config
-                ha_topic = f"homeassistant/{ha_sensor.get('sensor_type')}/{self.serial_number}_{self.cleanName(ha_sensor.get('name'))}/config"
+                ha_topic = f"homeassistant/{ha_sensor.get('sensor_type')}/{serial_number}_{self.cleanName(ha_sensor.get('name'))}/config"
                 logging.debug(f'MQTT: Topic; {ha_topic}, Message: {config_msg}')
-                self.mqtt_queue.append(self.mqtt_client.publish(ha_topic, json.dumps(config_msg), retain=True, qos=1).mid)
-            self.ha_discovery_published = True
+                self.send(ha_topic, json.dumps(config_msg), qos=1, retain=True)
+            self.ha_discovery_published.append(serial_number)
             logging.info("MQTT: Published Home Assistant Discovery messages")
         if self.topics:
             for topic in self.topics:
-                self.mqtt_queue.append(self.mqtt_client.publish(topic.get('topic'), inverter.getRegisterValue(topic.get('register')), qos=0).mid)
+                self.send(self.formatTopic(topic.get('topic'), inverter), inverter.getRegisterValue(topic.get('register')))
             logging.info("MQTT: Published custom mqtt topics")
 
-        payload = json.dumps(inverter.inverter_config | inverter.client_config | inverter.latest_scrape).replace('"', '\"')
-        logging.debug(f"MQTT: Publishing Registers: {self.mqtt_config['topic']} : {payload}")
-        self.mqtt_queue.append(self.mqtt_client.publish(self.mqtt_config['topic'], payload, qos=0).mid)
+        if self.mqtt_config['mode'] == 'registers':
+            self.publish_registers(inverter, state_topic)
+            return True
+
+        payload = json.dumps(inverter.inverter_config | inverter.client_config | inverter.latest_scrape)
+        logging.debug(f"MQTT: Publishing Registers: {state_topic} : {payload}")
+        self.send(state_topic, payload)
         logging.info(f"MQTT: Registers Published")
 
         return True
+
+    def publish_registers(self, inverter, state_topic):
+        """Publish each register to <topic>/<register>, only when it changed more than its deadband or
+        has not been published for heartbeat seconds. Config is published once, retained, to <topic>/config
+        """
+        serial_number = inverter.getSerialNumber()
+        if serial_number not in self.config_published:
+            payload = json.dumps(inverter.inverter_config | inverter.client_config)
+            self.send(f"{state_topic}/config", payload, retain=True)
+            self.config_published.append(serial_number)
+
+        now = time.monotonic()
+        published = self.published_values.setdefault(serial_number, {})
+        count = 0
+        for register, value in inverter.latest_scrape.items():
+            if value is None:
+                continue
+            last = published.get(register)
+            if last is not None and now - last[1] < self.mqtt_config['heartbeat'] and not self.changed(register, value, last[0]):
+                continue
+            # Retained, as unchanged registers are not published every scrape
+            self.send(f"{state_topic}/{register}", value, retain=True)
+            published[register] = (value, now)
+            count += 1
+        logging.info(f"MQTT: {count} changed registers published")
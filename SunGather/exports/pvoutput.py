@@ -2,6 +2,13 @@ import logging
 import requests
 import datetime
 import time
+from collections import deque
+from threading import Event, Thread
+from spool import Spool
+from paths import data_path
+
+# PVOutput accepts at most 30 statuses per addbatchstatus request
+MAX_BATCH = 30
 
 """
     See: https://pvoutput.org/help/api_specification.html#add-status-service
@@ -30,6 +37,9 @@ import time
     m1          Text Message 1      No          text        30 chars max    Yes
 """
 class export_pvoutput(object):
+    # A PVOutput system is a single inverter, when polling several only the primary (or serial:) is uploaded
+    single_inverter = True
+
     def __init__(self):
         self.url_base = "https://pvoutput.org/service/r2/"
         self.url_addbatchstatus = self.url_base + "addbatchstatus.jsp"
@@ -38,6 +48,18 @@ class export_pvoutput(object):
         self.url_getsystem = self.url_base + "getsystem.jsp"
         self.tid = '1618'
         self.status_interval = 5
+        # Keep-alive connection reused by every request
+        self.session = requests.Session()
+        # Data points waiting to be uploaded, kept until PVOutput accepts them
+        self.backlog = None
+        self.upload_wanted = Event()
+        self.request_times = deque()
+        self.hold_until = 0
+        self.retry_delay = 0
+        self.retry_at = 0
+        # Scrapes are averaged by the dispatcher, one window per status interval
+        self.window = self.status_interval * 60
+        self.aggregate = "mean"
 
     @property
     def headers(self):
@@ -55,14 +77,15 @@ class export_pvoutput(object):
             'join_team': config.get('join_team', True),
             'rate_limit': config.get('rate_limit', 60),
             'cumulative_flag': config.get('cumulative_flag',0),
-            'batch_points': config.get('batch_points',1)
+            'batch_points': config.get('batch_points',1),
+            # On disk by default so a restart keeps data points not yet uploaded, backlog: False keeps them in memory
+            'backlog': config.get('backlog', data_path(f"pvoutput-backlog-{inverter.getSerialNumber()}.db")),
+            'backlog_size': config.get('backlog_size', 4032)
         }
         self.pvoutput_parameters = [{}]
         self.pvoutput_parameters.pop() # Remove null value from list
 
         self.collected_data = {}
-        self.batch_data = []
-        self.batch_count = 0
         self.last_run = 0
         self.last_publish = 0
         
@@ -72,9 +95,12 @@ class export_pvoutput(object):
                 return False
             self.pvoutput_parameters.append(parameter)
 
+        self.session.headers.update(self.headers)
+        invertername = self.pvoutput_config['sid']
+        team_member = None
         try:
             logging.debug(f"PVOutput: Get System ; {self.url_getsystem}, {str(self.headers)}, 'teams': '1'")
-            response = requests.post(url=self.url_getsystem,headers=self.headers, params={'teams': '1'}, timeout=3)
+            response = self.post(self.url_getsystem, {'teams': '1'})
             logging.debug(f"PVOutput: Response; {str(response.status_code)} Message; {str(response.content)}")
 
             if response.status_code == 200:
@@ -91,27 +117,114 @@ class export_pvoutput(object):
                         break
             else:
                 logging.error(f"PVOutput: System Status Failed; {str(response.status_code)} Message; {str(response.content)}")
-        
+
+        except requests.exceptions.RequestException as err:
+            # Keep collecting while offline, the backlog is uploaded once PVOutput is reachable
+            logging.warning(f"PVOutput: Could not reach PVOutput, collecting every {self.status_interval} minutes until it is reachable")
+            logging.debug(f"{err}")
         except Exception as err:
             logging.error(f"PVOutput: Failed to configure")
             logging.debug(f"{err}")
             return False
 
         try:
-            if not team_member and self.pvoutput_config['join_team']:
+            if team_member is False and self.pvoutput_config['join_team']:
                 logging.debug(f"PVOutput: Join Team; {self.url_jointeam}, {str(self.headers)}, 'tid': '{self.tid}'")
-                response = requests.post(url=self.url_jointeam,headers=self.headers, params={'tid': self.tid}, timeout=3)
+                response = self.post(self.url_jointeam, {'tid': self.tid})
                 logging.debug(f"PVOutput: Response; {str(response.status_code)} Message; {str(response.content)}")
             elif team_member and not self.pvoutput_config['join_team']:
                 logging.debug(f"PVOutput: Leave Team; {self.url_leaveteam}, {str(self.headers)}, 'tid': '{self.tid}'")
-                response = requests.post(url=self.url_leaveteam,headers=self.headers, params={'tid': self.tid}, timeout=3)
+                response = self.post(self.url_leaveteam, {'tid': self.tid})
                 logging.debug(f"PVOutput: Response; {str(response.status_code)} Message; {str(response.content)}")  
         except Exception as err:
             pass
 
+        self.window = self.status_interval * 60
+        self.backlog = Spool(self.pvoutput_config['backlog'] or None, self.pvoutput_config['backlog_size'], "PVOutput")
+        if len(self.backlog):
+            self.upload_wanted.set()
+        Thread(target=self.upload_loop, name="pvoutput-upload", daemon=True).start()
+
         logging.info(f"PVOutput: Configured export to {invertername} every {self.status_interval} minutes")
         return True
 
+    def post(self, url, params, timeout=3):
+        """POST on the keep-alive session, every request counts towards PVOutput's hourly limit"""
+        self.request_times.append(time.time())
+        response = self.session.post(url=url, params=params, timeout=timeout)
+        # PVOutput reports the requests left this hour and when the count resets (epoch)
+        remaining = response.headers.get('X-Rate-Limit-Remaining')
+        reset = response.headers.get('X-Rate-Limit-Reset')
+        if remaining is not None and reset is not None and int(remaining) <= 0:
+            self.hold_until = max(self.hold_until, float(reset))
+        return response
+
+    def rate_wait(self):
+        """Seconds until another request fits in the hourly limit"""
+        now = time.time()
+        while self.request_times and self.request_times[0] <= now - 3600:
+            self.request_times.popleft()
+        wait = self.hold_until - now
+        if len(self.request_times) >= self.pvoutput_config['rate_limit']:
+            wait = max(wait, self.request_times[0] + 3600 - now)
+        return max(wait, 0)
+
+    def upload_loop(self):
+        """Upload the backlog oldest first, 30 data points per request, within the hourly limit"""
+        delay = None
+        while True:
+            self.upload_wanted.wait(delay)
+            self.upload_wanted.clear()
+            delay = None
+            while len(self.backlog) >= self.pvoutput_config['batch_points']:
+                if time.time() < self.retry_at:
+                    # New data points do not cut the back off short
+                    delay = self.retry_at - time.time()
+                    break
+                wait = self.rate_wait()
+                if wait > 0:
+                    logging.warning(f"PVOutput: Hourly request limit reached, {len(self.backlog)} data points waiting, next upload in {int(wait)} secs")
+                    delay = wait
+                    break
+
+                batch = self.backlog.peek(MAX_BATCH)
+                payload = {'data': ";".join(data_point for id, data_point in batch)}
+                if self.pvoutput_config['cumulative_flag'] > 0:
+                    payload['c1'] = self.pvoutput_config['cumulative_flag']
+
+                try:
+                    logging.debug("PVOutput: Request; " + self.url_addbatchstatus + ", " + str(self.headers) + " : " + str(payload))
+                    response = self.post(self.url_addbatchstatus, payload, timeout=10)
+                except Exception as err:
+                    delay = self.retry(err)
+                    break
+
+                if response.status_code == requests.codes.ok:
+                    self.backlog.ack(batch[-1][0])
+                    self.retry_delay = 0
+                    logging.info(f"PVOutput: Data uploaded, {len(batch)} data points, {len(self.backlog)} waiting")
+                elif response.status_code == 400:
+                    # Retrying would fail the same way (e.g. points older than PVOutput accepts) and hold up every later point
+                    logging.error(f"PVOutput: Dropped {len(batch)} data points rejected by PVOutput; {str(response.text)}")
+                    self.backlog.ack(batch[-1][0])
+                else:
+                    delay = self.retry(f"{str(response.status_code)} Message; {str(response.text)}")
+                    break
+
+    def retry(self, err):
+        self.retry_delay = min(max(self.retry_delay * 2, 60), 3600)
+        self.retry_at = time.time() + self.retry_delay
+        logging.error(f"PVOutput: Upload Failed, {len(self.backlog)} data points waiting, retrying in {self.retry_delay} secs; {err}")
+        return self.retry_delay
+
+    def cumulative(self, field):
+        """Lifetime or daily energy totals, these use the last reading rather than the average"""
+        if field == 'v1':
+            return self.pvoutput_config['cumulative_flag'] in (1, 2)
+        if field == 'v3':
+            return self.pvoutput_config['cumulative_flag'] in (1, 3)
+        return False
+
     def collect_data(self, inverter):
         # Check all required registers have been returned by the inverter
         if not inverter.validateLatestScrape('timestamp'):
@@ -122,28 +235,18 @@ class export_pvoutput(object):
                 logging.error(f"PVOutput: Skipped collecting data,  {parameter['register']} missing from last scrape")
                 return False
 
-        # Add new data to old data and increase count of data points
+        # Windowed snapshots carry the time-weighted average of the status interval, and the last reading
+        window = getattr(inverter, 'window', None)
         for parameter in self.pvoutput_parameters:
-            value = inverter.getRegisterValue(parameter.get('register'))
+            if window and self.cumulative(parameter.get('name')):
+                value = window.values['last'][parameter.get('register')]
+            else:
+                value = inverter.getRegisterValue(parameter.get('register'))
 
             if parameter.get('multiple'):
                 value = value * parameter.get('multiple')
 
-            # If using Cumulative Energy we just need the last data point, not the average
-            if parameter.get('name') == 'v1' and (self.pvoutput_config['cumulative_flag'] == 1 or self.pvoutput_config['cumulative_flag'] == 2):
-                self.collected_data[parameter.get('name')] = value
-            elif parameter.get('name') == 'v3' and (self.pvoutput_config['cumulative_flag'] == 1 or self.pvoutput_config['cumulative_flag'] == 3):
-                self.collected_data[parameter.get('name')] = value
-            # Add the last data point to the previous data point if exists, otherwise set as the last data point
-            elif self.collected_data.get(parameter.get('name'),False):
-                self.collected_data[parameter.get('name')] = round(self.collected_data[parameter.get('name')] + value,3)
-            else:
-                self.collected_data[parameter.get('name')] = value
-
-        if self.collected_data.get('count',False):
-            self.collected_data['count'] +=1
-        else:
-            self.collected_data['count'] = 1
+            self.collected_data[parameter.get('name')] = value
 
         logging.debug(f'PVOutput: Data Logged: {self.collected_data}')
 
@@ -151,8 +254,8 @@ class export_pvoutput(object):
 
     def publish(self, inverter):
         if self.collect_data(inverter):
-            # Process data points every status_interval
-            if((time.time() - self.last_publish) >= (self.status_interval * 60)):
+            # Each window is one status, without a window (window: 0) the reading is sampled every status_interval
+            if getattr(inverter, 'window', None) or ((time.time() - self.last_publish) >= (self.status_interval * 60)):
                 any_data = False
                 if inverter.validateLatestScrape('timestamp'):
                     now = datetime.datetime.strptime(inverter.getRegisterValue('timestamp'), "%Y-%m-%d %H:%M:%S")
@@ -160,14 +263,12 @@ class export_pvoutput(object):
                     for x in range(1, 13):
                         field = 'v' + str(x)
                         if self.collected_data.get(field):
-                            if x == 1  and (self.pvoutput_config['cumulative_flag'] == 1 or self.pvoutput_config['cumulative_flag'] == 2):
-                                value = int(self.collected_data[field])
-                            elif x == 3 and (self.pvoutput_config['cumulative_flag'] == 1 or self.pvoutput_config['cumulative_flag'] == 3):
+                            if self.cumulative(field):
                                 value = int(self.collected_data[field])
                             elif x == 6 or x == 7:    # Round to 1 decimal place
-                                value = round(self.collected_data[field] / self.collected_data['count'], 1)
+                                value = round(self.collected_data[field], 1)
                             else:                     # Getting errors when uploading decimals for power/energy so return INT
-                                value = int((self.collected_data[field] / self.collected_data['count']))
+                                value = int(self.collected_data[field])
                             data_point = data_point + "," + str(value)
                             any_data = True
                         else:
@@ -175,49 +276,14 @@ class export_pvoutput(object):
                     self.collected_data = {}
 
                 if any_data:
-                    self.batch_data.append(data_point)
+                    self.backlog.put(data_point)
                 else:
                     logging.warning(f"PVOutput: No data collected in last {(self.status_interval * 60)} minutes")
+                self.last_publish = time.time()
 
-                # Max upload is 30, if over 30 then remove the oldest one
-                if self.batch_data.__len__() > 30:
-                    logging.warning(f"PVOutput: Over 30 data points scheduled to upload. max is 30 so removing oldest data point")
-                    self.batch_data.pop(0)
-
-                self.batch_count +=1
-                if self.batch_count >= self.pvoutput_config['batch_points']:
-                    if not self.batch_data.__len__() > 0:
-                        logging.warning(f"PVOutput: No data collected in last {((self.status_interval * 60) * self.batch_count)} minutes, Skipping upload")
-                        return False
-                    elif self.batch_data.__len__() >= 1:
-                        payload_data = None
-                        for data in self.batch_data:
-                            if payload_data:
-                                payload_data = payload_data + ";" + data
-                            else:
-                                payload_data = data
-
-                    payload = {}
-                    payload['data'] = payload_data
-
-                    if self.pvoutput_config['cumulative_flag'] > 0:
-                        payload['c1'] = self.pvoutput_config['cumulative_flag']
-
-                    try:
-                        logging.debug("PVOutput: Request; " + self.url_addbatchstatus + ", " + str(self.headers) + " : " + str(payload))
-                        response = requests.post(url=self.url_addbatchstatus, headers=self.headers, params=payload, timeout=3)
-                        self.batch_count = 0
-
-                        if response.status_code != requests.codes.ok:
-                            logging.error(f"PVOutput: Upload Failed; {str(response.status_code)} Message; {str(response.text)}")
-                            logging.error("PVOutput: Request; " + self.url_addbatchstatus + ", " + str(self.headers) + " : " + str(payload))
-                        else:
-                            self.batch_data = []
-                            self.last_publish = time.time()
-                            logging.info("PVOutput: Data uploaded")
-                    except Exception as err:
-                        logging.error(f"PVOutput: Failed to Upload")
-                        logging.debug(f"{err}")
+                if len(self.backlog) >= self.pvoutput_config['batch_points']:
+                    self.upload_wanted.set()
+                    logging.info(f"PVOutput: Data queued for upload, {len(self.backlog)} data points waiting")
                 else:
                     logging.info("PVOutput: Data added to next batch upload")
             else:
@@ -1,17 +1,34 @@
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from threading import Thread
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+from threading import Thread, BoundedSemaphore
 from version import __version__
+from instrumentation import REGISTRY
+from exposition import MetricsExposition, accepts_openmetrics, CONTENT_TYPE_TEXT, CONTENT_TYPE_OPENMETRICS
 from urllib.parse import parse_qs, urlparse
 
+import gzip
 import json
 import logging
 import urllib
 import time
 from datetime import datetime
+from email.utils import formatdate
 
 class export_webserver(object):
     html_body = "Pending Data Retrieval"
-    metrics = ""
+    primary = None
+    # Latest scrape per inverter serial number, the primary inverter is shown unless ?serial= is used.
+    # Pages are rendered on the first request after each scrape and kept as bytes until the next one
+    pages = {}
+    generation = 0
+    # Start of this process, generation restarts at 0 so ETags include it to differ between restarts
+    started = format(int(time.time()), "x")
+    compress = True
+    # (serial, register name): (address, unit), models differ in addresses and units
+    registers = {}
+    health_bodies = {}
+    # Prometheus names and labels are compiled once per inverter, see exposition.py
+    exposition = MetricsExposition()
+    metrics_cache = None
     health_data = {
         "status": "initializing",
         "uptime_start": time.time(),
@@ -27,12 +44,20 @@ class export_webserver(object):
     # Configure Webserver
     def configure(self, config, inverter):
         try:
-            self.webServer = HTTPServer(('', config.get('port',8080)), MyServer)
+            export_webserver.compress = config.get('compress', True)
+            if config.get('threaded', True):
+                # Each connection gets a thread, so a slow client or a Prometheus scrape never holds up /health
+                MyServer.protocol_version = "HTTP/1.1"
+                MyServer.timeout = config.get('keep_alive', 15)
+                self.webServer = WebServer(('', config.get('port',8080)), MyServer, config.get('max_connections', 32))
+            else:
+                self.webServer = HTTPServer(('', config.get('port',8080)), MyServer)
             self.t = Thread(target=self.webServer.serve_forever)
             self.t.daemon = True    # Make it a deamon, so if main loop ends the webserver dies
             self.t.start()
             export_webserver.health_data["status"] = "healthy"
-            logging.info(f"Webserver: Configured")
+            export_webserver.primary = inverter.getSerialNumber()
+            logging.info(f"Webserver: Configured" + (f", threaded with up to {self.webServer.max_connections} connections" if isinstance(self.webServer, WebServer) else ""))
         except Exception as err:
             export_webserver.health_data["status"] = "unhealthy"
             logging.error(f"Webserver: Error: {err}")
@@ -55,38 +80,21 @@ class export_webserver(object):
             config_body += f'<td><input type="checkbox" id="update_{str(setting)}" name="update_{str(setting)}" value="False"></td></tr>' 
         #config_body += f'</table><input type="submit" value="Submit"></form>'
         config_body += f'</table>Currently ReadOnly, No save function yet :(</form>'
-        export_webserver.config = config_body
+        export_webserver.config = bytes(config_body, "utf-8")
 
         return True
 
     def publish(self, inverter):
-        json_array={"registers":{}, "client_config":{}, "inverter_config":{}}
-        metrics_body = ""
-        main_body = f"""
-            <h3>SunGather v{__version__}</h3></p>
-            <h4>Need Help? <href a='https://github.com/bohdan-s/SunGather'>https://github.com/bohdan-s/SunGather</a></h4></p>
-            <h4>NEW HomeAssistant Add-on: <href a='https://github.com/bohdan-s/hassio-repository'>https://github.com/bohdan-s/SunGather</a></h4></p>
-            """
-        main_body += "<table><th>Address</th><tr><th>Register</th><th>Value</th></tr>"
-        for register, value in inverter.latest_scrape.items():
-            main_body += f"<tr><td>{str(inverter.getRegisterAddress(register))}</td><td>{str(register)}</td><td>{str(value)} {str(inverter.getRegisterUnit(register))}</td></tr>"
-            metrics_body += f"{str(register)}{{address=\"{str(inverter.getRegisterAddress(register))}\", unit=\"{str(inverter.getRegisterUnit(register))}\"}} {str(value)}\n"
-            json_array["registers"][str(inverter.getRegisterAddress(register))]={"register": str(register), "value":str(value), "unit": str(inverter.getRegisterUnit(register))}
-        main_body += f"</table><p>Total {len(inverter.latest_scrape)} registers"
+        # Pages are rendered when requested, publish only keeps the scrape (a dispatcher snapshot, so it is not changed later)
+        serial = inverter.getSerialNumber()
+        export_webserver.generation += 1
+        export_webserver.pages[serial] = {
+            "inverter": inverter,
+            "generation": export_webserver.generation,
+            "last_modified": formatdate(getattr(inverter, 'scrape_time', time.time()), usegmt=True),
+            "rendered": {}
+        }
 
-        main_body += "</p></p><table><tr><th>Configuration</th><th>Value</th></tr>"
-        for setting, value in inverter.client_config.items():
-            main_body += f"<tr><td>{str(setting)}</td><td>{str(value)}</td></tr>"
-            json_array["client_config"][str(setting)]=str(value)
-        for setting, value in inverter.inverter_config.items():
-            main_body += f"<tr><td>{str(setting)}</td><td>{str(value)}</td></tr>"
-            json_array["inverter_config"][str(setting)]=str(value)
-        main_body += f"</table></p>"
-
-        export_webserver.main = main_body
-        export_webserver.metrics = metrics_body
-        export_webserver.json = json.dumps(json_array)
-        
         # Update health data
         export_webserver.health_data["last_scrape_time"] = datetime.now().isoformat()
         export_webserver.health_data["last_scrape_success"] = True
@@ -95,14 +103,150 @@ class export_webserver(object):
         
         return True
 
+    @staticmethod
+    def register_info(inverter, register):
+        """Address and unit of a register, looked up once as they never change"""
+        key = (inverter.getSerialNumber(), register)
+        info = export_webserver.registers.get(key)
+        if info is None:
+            info = export_webserver.registers[key] = (str(inverter.getRegisterAddress(register)), str(inverter.getRegisterUnit(register)))
+        return info
+
+    @staticmethod
+    def render_main(inverter):
+        rows = []
+        for register, value in inverter.latest_scrape.items():
+            address, unit = export_webserver.register_info(inverter, register)
+            rows.append(f"<tr><td>{address}</td><td>{str(register)}</td><td>{str(value)} {unit}</td></tr>")
+        config_rows = [f"<tr><td>{str(setting)}</td><td>{str(value)}</td></tr>" for setting, value in (inverter.client_config | inverter.inverter_config).items()]
+        return "".join([
+            "<html><head><title>SunGather</title>",
+            "<meta charset='UTF-8'><meta http-equiv='refresh' content='15'>",
+            '<style media = "all"> body { background-color: black; color: white; } @media screen and (prefers-color-scheme: light) { body { background-color: white; color: black; } } </style>',
+            "</head><body>",
+            f"""
+            <h3>SunGather v{__version__}</h3></p>
+            <h4>Need Help? <href a='https://github.com/bohdan-s/SunGather'>https://github.com/bohdan-s/SunGather</a></h4></p>
+            <h4>NEW HomeAssistant Add-on: <href a='https://github.com/bohdan-s/hassio-repository'>https://github.com/bohdan-s/SunGather</a></h4></p>
+            """,
+            "<table><th>Address</th><tr><th>Register</th><th>Value</th></tr>",
+            *rows,
+            f"</table><p>Total {len(inverter.latest_scrape)} registers",
+            "</p></p><table><tr><th>Configuration</th><th>Value</th></tr>",
+            *config_rows,
+            "</table></p></table></body></html>"
+        ])
+
+    @staticmethod
+    def render_metrics(openmetrics):
+        """Register metrics of every inverter, rendered once per scrape of any inverter"""
+        pages = list(export_webserver.pages.items())
+        key = (tuple(page["generation"] for serial, page in pages), openmetrics)
+        cached = export_webserver.metrics_cache
+        if cached and cached[0] == key:
+            return cached[1]
+        body = export_webserver.exposition.render([(serial, page["inverter"]) for serial, page in pages], openmetrics).encode("utf-8")
+        export_webserver.metrics_cache = (key, body)
+        return body
+
+    @staticmethod
+    def render_json(inverter):
+        json_array = {"registers": {}, "client_config": {}, "inverter_config": {}}
+        for register, value in inverter.latest_scrape.items():
+            address, unit = export_webserver.register_info(inverter, register)
+            json_array["registers"][address] = {"register": str(register), "value": str(value), "unit": unit}
+        for setting, value in inverter.client_config.items():
+            json_array["client_config"][str(setting)] = str(value)
+        for setting, value in inverter.inverter_config.items():
+            json_array["inverter_config"][str(setting)] = str(value)
+        return json.dumps(json_array)
+
+    @staticmethod
+    def render(serial, kind, gzipped=False):
+        """Page body as bytes with its ETag and Last-Modified, rendered (and compressed) at most once per scrape"""
+        page = export_webserver.pages.get(serial, export_webserver.pages.get(export_webserver.primary))
+        if not page:
+            return None
+        rendered = page["rendered"].get(kind)
+        if rendered is None:
+            body = getattr(export_webserver, f"render_{kind}")(page["inverter"]).encode("utf-8")
+            rendered = page["rendered"][kind] = (body, f'"{export_webserver.started}-{page["generation"]}-{kind}"', page["last_modified"])
+        if gzipped:
+            compressed = page["rendered"].get(f"{kind}.gz")
+            if compressed is None:
+                compressed = page["rendered"][f"{kind}.gz"] = (gzip.compress(rendered[0], compresslevel=6), f'"{export_webserver.started}-{page["generation"]}-{kind}-gzip"', rendered[2])
+            return compressed
+        return rendered
+
+
+class WebServer(ThreadingHTTPServer):
+    """Threaded server with a cap on open connections, connections over the cap get a 503 straight away"""
+    daemon_threads = True
+
+    def __init__(self, address, handler, max_connections=32):
+        self.max_connections = max_connections
+        self.connections = BoundedSemaphore(max_connections)
+        super().__init__(address, handler)
+
+    def process_request(self, request, client_address):
+        if not self.connections.acquire(blocking=False):
+            logging.warning(f"Webserver: {self.max_connections} connections open, rejected {client_address[0]}")
+            try:
+                request.sendall(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nRetry-After: 1\r\nConnection: close\r\n\r\n")
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        super().process_request(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.connections.release()
+
 class MyServer(BaseHTTPRequestHandler):
+    def _serial(self):
+        return parse_qs(urlparse(self.path).query).get('serial', [export_webserver.primary])[0]
+
+    def _not_modified(self, etag, last_modified):
+        if self.headers.get('If-None-Match'):
+            return etag in [tag.strip() for tag in self.headers.get('If-None-Match').split(',')] or self.headers.get('If-None-Match').strip() == '*'
+        return self.headers.get('If-Modified-Since') == last_modified
+
+    def _accepts_gzip(self):
+        return export_webserver.compress and 'gzip' in self.headers.get('Accept-Encoding', '')
+
+    def _send(self, content_type, body, etag=None, last_modified=None, gzipped=False):
+        if etag and self._not_modified(etag, last_modified):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+            self.send_header("Vary", "Accept-Encoding")
+        if etag:
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_page(self, kind, content_type, pending, compressible=False):
+        gzipped = compressible and self._accepts_gzip()
+        rendered = export_webserver.render(self._serial(), kind, gzipped)
+        if rendered is None:
+            self._send(content_type, pending)
+        else:
+            self._send(content_type, *rendered, gzipped=gzipped)
+
     def do_GET(self):
         if self.path.startswith('/health/detailed'):
             # Detailed health check with full status information
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            
             uptime_seconds = int(time.time() - export_webserver.health_data["uptime_start"])
             
             health_response = {
@@ -117,63 +261,46 @@ class MyServer(BaseHTTPRequestHandler):
                 "timestamp": datetime.now().isoformat()
             }
             
-            self.wfile.write(bytes(json.dumps(health_response, indent=2), "utf-8"))
+            self._send("application/json", bytes(json.dumps(health_response, indent=2), "utf-8"))
             
         elif self.path.startswith('/health'):
-            # Simple health check - just HTTP 200 if healthy
+            # Simple health check - just HTTP 200 if healthy, the body only changes with the status
             status = export_webserver.health_data["status"]
-            if status == "healthy":
-                self.send_response(200)
-            elif status == "degraded":
-                self.send_response(503)  # Service Unavailable
-            else:
-                self.send_response(503)
-                
+            if status not in export_webserver.health_bodies:
+                export_webserver.health_bodies[status] = bytes(json.dumps({"status": status, "version": __version__}), "utf-8")
+            body = export_webserver.health_bodies[status]
+            self.send_response(200 if status == "healthy" else 503)   # Service Unavailable when degraded or unhealthy
             self.send_header("Content-type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
             self.end_headers()
-            
-            simple_response = {
-                "status": status,
-                "version": __version__
-            }
-            
-            self.wfile.write(bytes(json.dumps(simple_response), "utf-8"))
+            self.wfile.write(body)
             
         elif self.path.startswith('/metrics'):
-            self.send_response(200)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(bytes(export_webserver.metrics, "utf-8"))
+            # Timing metrics change constantly, so only the register part is cached
+            openmetrics = accepts_openmetrics(self.headers.get('Accept'))
+            body = export_webserver.render_metrics(openmetrics) + bytes(REGISTRY.render(openmetrics), "utf-8")
+            if openmetrics:
+                body += b"# EOF\n"
+            content_type = CONTENT_TYPE_OPENMETRICS if openmetrics else CONTENT_TYPE_TEXT
+            if self._accepts_gzip():
+                self._send(content_type, gzip.compress(body, compresslevel=6), gzipped=True)
+            else:
+                self._send(content_type, body)
         elif self.path.startswith('/config'):
-            self.send_response(200)
-            self.send_header("Content-type", "text/html")
-            self.end_headers()
-            self.wfile.write(bytes(export_webserver.config, "utf-8"))
+            self._send("text/html", export_webserver.config)
             parsed_data = parse_qs(urlparse(self.path).query)
             logging.info(f"{parsed_data}")
         elif self.path.startswith('/json'):
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(bytes(export_webserver.json, "utf-8"))
+            self._send_page("json", "application/json", b"{}", compressible=True)
         else:
-            self.send_response(200)
-            self.send_header("Content-type", "text/html")
-            self.end_headers()
-            self.wfile.write(bytes("<html><head><title>SunGather</title>", "utf-8"))
-            self.wfile.write(bytes("<meta charset='UTF-8'><meta http-equiv='refresh' content='15'>", "utf-8"))
-            self.wfile.write(bytes('<style media = "all"> body { background-color: black; color: white; } @media screen and (prefers-color-scheme: light) { body { background-color: white; color: black; } } </style>', "utf-8"))
-            self.wfile.write(bytes("</head>", "utf-8"))
-            self.wfile.write(bytes("<body>", "utf-8"))
-            self.wfile.write(bytes(export_webserver.main, "utf-8"))
-            self.wfile.write(bytes("</table>", "utf-8"))
-            self.wfile.write(bytes("</body></html>", "utf-8"))
+            self._send_page("main", "text/html", bytes(f"<html><head><title>SunGather</title><meta charset='UTF-8'><meta http-equiv='refresh' content='15'></head><body>{export_webserver.html_body}</body></html>", "utf-8"))
 
     def do_POST(self):
-        length = int(self.headers['Content-Length'])
+        length = int(self.headers.get('Content-Length', 0))
         post_data = urllib.parse.parse_qs(self.rfile.read(length).decode('utf-8'))
         logging.info(f"{post_data}")
-        self.wfile.write(post_data.encode("utf-8"))
+        # A response is always sent, keep-alive clients would otherwise wait for one
+        self._send("application/json", bytes(json.dumps(post_data), "utf-8"))
 
     def log_message(self, format, *args):
         pass
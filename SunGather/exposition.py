@@ -0,0 +1,190 @@
+from threading import Lock
+
+import re
+
+PREFIX = "sungather_"
+
+CONTENT_TYPE_TEXT = "text/plain; version=0.0.4; charset=utf-8"
+CONTENT_TYPE_OPENMETRICS = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# Registers file unit: metric name suffix, values are exposed as read (no conversion to base units)
+UNIT_SUFFIXES = {
+    "W": "watts",
+    "kW": "kilowatts",
+    "KW": "kilowatts",
+    "kWh": "kilowatt_hours",
+    "V": "volts",
+    "A": "amperes",
+    "Hz": "hertz",
+    "°C": "celsius",
+    "%": "percent",
+    "h": "hours",
+    "min": "minutes",
+    "VA": "voltamperes",
+    "Var": "vars",
+    "kVar": "kilovars",
+    "k-ohm": "kiloohms",
+    "kg": "kilograms"
+}
+
+# Enums with more states than this are exposed as an info metric rather than a state set
+MAX_STATES = 16
+
+def accepts_openmetrics(accept):
+    return 'application/openmetrics-text' in (accept or '')
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _metric_name(name):
+    return PREFIX + re.sub(r'[^a-zA-Z0-9_]', '_', str(name)).lower()
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+class Family(object):
+    """One metric family, its HELP / TYPE lines are formatted once for both exposition formats"""
+    def __init__(self, name, kind, help, unit=None):
+        self.name = name
+        self.kind = kind
+        self.unit = unit
+        if kind == "counter":
+            self.sample = f"{name}_total"
+            text_kind, text_name = "counter", self.sample
+        elif kind == "info":
+            self.sample = f"{name}_info"
+            text_kind, text_name = "gauge", self.sample
+        else:
+            self.sample = name
+            text_kind, text_name = ("gauge" if kind == "stateset" else kind), name
+        self.header_text = f"# HELP {text_name} {help}\n# TYPE {text_name} {text_kind}\n"
+        self.header_openmetrics = f"# HELP {name} {help}\n# TYPE {name} {kind}\n" + (f"# UNIT {name} {unit}\n" if unit else "")
+
+
+class CompiledInverter(object):
+    """Sample prefixes of one inverter, so a scrape only formats the values"""
+    def __init__(self, exposition, inverter, serial):
+        self.serial = serial
+        self.label = f'inverter="{_escape(serial)}"'
+        self.model = inverter.getInverterModel()
+        self.samples = {}   # register: (family, sample prefix, or {state: prefix} for state sets)
+        self.info_lines = {}
+
+        for register in list(inverter.registers) + list(inverter.registers_custom):
+            name = register.get('name')
+            if name in self.samples:
+                continue
+            family = exposition.family(register)
+            if family is None:
+                continue
+            if family.kind == "stateset":
+                states = exposition.states[name]
+                self.samples[name] = (family, {state: f'{family.name}{{{self.label},{family.name}="{_escape(state)}"}} ' for state in states})
+            elif family.kind == "info":
+                self.samples[name] = (family, None)
+            else:
+                self.samples[name] = (family, f"{family.sample}{{{self.label}}} ")
+
+        self.identity = f'{PREFIX}inverter_info{{{self.label},model="{_escape(self.model)}"}} 1\n'
+
+    def info_line(self, family, value):
+        line = self.info_lines.get((family.name, value))
+        if line is None:
+            line = self.info_lines[(family.name, value)] = f'{family.sample}{{{self.label},value="{_escape(value)}"}} 1\n'
+        return line
+
+
+class MetricsExposition(object):
+    """Prometheus / OpenMetrics page of the latest scrapes.
+
+    Metric names, HELP / TYPE metadata and label strings are built once from the
+    registers (unit, datatype, datarange). Numeric registers are gauges, lifetime
+    energy totals are counters, enums are state sets (or info metrics when they have
+    many states) and other string values (timestamps, serial number) are left out.
+    """
+    def __init__(self):
+        self.families = {}
+        self.states = {}
+        self.inverters = {}
+        self.identity = Family(f"{PREFIX}inverter", "info", "Inverter model by serial number")
+        self.lock = Lock()
+
+    def family(self, register):
+        name = register.get('name')
+        if name in self.families:
+            # Some registers are defined per model with different states, a state set covers all of them
+            if name in self.states and register.get('datarange'):
+                for value in register.get('datarange'):
+                    if value.get('value') not in self.states[name]:
+                        self.states[name].append(value.get('value'))
+            return self.families[name]
+
+        family = None
+        datarange = register.get('datarange')
+        if register.get('datatype') == "UTF-8" or register.get('address') in ("vr002", "vr003"):
+            family = None
+        elif datarange and not all(_is_number(value.get('value')) for value in datarange):
+            states = []
+            for value in datarange:
+                if value.get('value') not in states:
+                    states.append(value.get('value'))
+            metric = _metric_name(name)
+            if len(states) > MAX_STATES:
+                family = Family(metric, "info", f"{name} (register {register.get('address')})")
+            else:
+                self.states[name] = states
+                family = Family(metric, "stateset", f"{name} (register {register.get('address')})")
+        elif name == "run_state":
+            self.states[name] = ["ON", "OFF"]
+            family = Family(_metric_name(name), "stateset", f"{name} (register {register.get('address')})")
+        elif register.get('datatype') or register.get('unit'):
+            suffix = UNIT_SUFFIXES.get(register.get('unit'))
+            metric = _metric_name(name) + (f"_{suffix}" if suffix and not name.endswith(suffix) else "")
+            kind = "counter" if register.get('unit') == "kWh" and name.startswith("total_") else "gauge"
+            family = Family(metric, kind, f"{name} in {register.get('unit')} (register {register.get('address')})" if register.get('unit') else f"{name} (register {register.get('address')})", suffix)
+        self.families[name] = family
+        return family
+
+    def compile(self, inverter, serial):
+        compiled = self.inverters.get(serial)
+        if compiled is None or compiled.model != inverter.getInverterModel():
+            with self.lock:
+                compiled = self.inverters[serial] = CompiledInverter(self, inverter, serial)
+        return compiled
+
+    def render(self, inverters, openmetrics=False):
+        """Exposition of several inverters, each a (serial, inverter or snapshot) pair.
+        Samples are grouped by family, a family's HELP / TYPE may only appear once.
+        """
+        samples = {}
+        order = []
+        identity = []
+        for serial, inverter in inverters:
+            compiled = self.compile(inverter, serial)
+            identity.append(compiled.identity)
+            for register, value in inverter.latest_scrape.items():
+                entry = compiled.samples.get(register)
+                if entry is None:
+                    continue
+                family, prefix = entry
+                if family.name not in samples:
+                    samples[family.name] = (family, [])
+                    order.append(family.name)
+                lines = samples[family.name][1]
+                if family.kind == "stateset":
+                    for state, state_prefix in prefix.items():
+                        lines.append(f"{state_prefix}{1 if state == value else 0}\n")
+                elif family.kind == "info":
+                    if value is not None:
+                        lines.append(compiled.info_line(family, value))
+                elif _is_number(value):
+                    lines.append(f"{prefix}{value}\n")
+
+        header = "header_openmetrics" if openmetrics else "header_text"
+        output = [getattr(self.identity, header)] + identity if identity else []
+        for name in order:
+            family, lines = samples[name]
+            if lines:
+                output.append(getattr(family, header))
+                output.extend(lines)
+        return "".join(output)
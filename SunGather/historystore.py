@@ -0,0 +1,200 @@
+from threading import Lock, Thread, Event, local
+
+import logging
+import math
+import os
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS registers (
+    id INTEGER PRIMARY KEY,
+    serial TEXT NOT NULL,
+    name TEXT NOT NULL,
+    unit TEXT,
+    address TEXT,
+    UNIQUE (serial, name)
+);
+CREATE TABLE IF NOT EXISTS scrapes (
+    serial TEXT NOT NULL,
+    ts REAL NOT NULL,
+    PRIMARY KEY (serial, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS samples (
+    register_id INTEGER NOT NULL,
+    ts REAL NOT NULL,
+    value,
+    PRIMARY KEY (register_id, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollups (
+    register_id INTEGER NOT NULL,
+    ts REAL NOT NULL,
+    min REAL,
+    max REAL,
+    avg REAL,
+    last,
+    count INTEGER,
+    PRIMARY KEY (register_id, ts)
+) WITHOUT ROWID;
+"""
+
+# Roll up the raw samples of every complete bucket older than the cutoff, last is the value at the latest timestamp
+ROLLUP = """
+INSERT OR REPLACE INTO rollups (register_id, ts, min, max, avg, last, count)
+SELECT bucket.register_id, bucket.start, bucket.min, bucket.max, bucket.avg,
+       (SELECT value FROM samples WHERE samples.register_id = bucket.register_id AND samples.ts = bucket.last_ts),
+       bucket.count
+FROM (
+    SELECT register_id, CAST(ts / :step AS INTEGER) * :step AS start, min(value) AS min, max(value) AS max,
+           avg(value) AS avg, max(ts) AS last_ts, count(*) AS count
+    FROM samples WHERE ts < :cutoff GROUP BY register_id, start
+) AS bucket
+"""
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+class HistoryStore(object):
+    """Scraped values on disk, in SQLite with write-ahead logging.
+
+    Each scrape is written in one transaction, so a crash or power cut loses at most
+    the last scrapes and never leaves a partial one. Numeric registers are kept raw for
+    raw_days, then rolled up into step second buckets (min, max, avg, last) kept for
+    retention_days. Compaction runs on a background thread every compact_interval seconds.
+    """
+    def __init__(self, path, retention_days=365, raw_days=7, step=300, compact_interval=3600, registers=None):
+        self.path = path
+        self.retention = retention_days * 86400
+        self.raw = raw_days * 86400
+        self.step = max(int(step), 1)
+        self.compact_interval = compact_interval
+        self.registers = set(registers) if registers else None
+        self.register_ids = {}      # (serial, register): id
+        self.scrapes = {}           # serial: raw scrapes stored
+        self.readers = local()
+        self.lock = Lock()
+        self.stopped = Event()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.connection = self._connect()
+        with self.lock, self.connection:
+            self.connection.executescript(SCHEMA)
+            for id, serial, name in self.connection.execute("SELECT id, serial, name FROM registers"):
+                self.register_ids[(serial, name)] = id
+            for serial, count in self.connection.execute("SELECT serial, count(*) FROM scrapes GROUP BY serial"):
+                self.scrapes[serial] = count
+
+        self.compactor = Thread(target=self._compact_loop, name="history-compaction", daemon=True)
+        self.compactor.start()
+        logging.info(f"History: Storing history in {path}, raw for {raw_days} days, {self.step}s rollups for {retention_days} days")
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # With WAL, NORMAL only syncs at checkpoints, the database stays consistent after a power cut
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _reader(self):
+        """Connection of the calling thread, WAL lets reads run while a scrape is written"""
+        connection = getattr(self.readers, 'connection', None)
+        if connection is None:
+            connection = self.readers.connection = self._connect()
+        return connection
+
+    def append(self, serial, timestamp, values, meta=None):
+        """Write one scrape, values is {register: value}, meta is {register: (unit, address)}"""
+        meta = meta or {}
+        values = {
+            register: value for register, value in values.items()
+            if _is_number(value) and (self.registers is None or register in self.registers)
+        }
+        with self.lock:
+            new = [register for register in values if (serial, register) not in self.register_ids]
+            if new:
+                with self.connection:
+                    self.connection.executemany(
+                        "INSERT OR IGNORE INTO registers (serial, name, unit, address) VALUES (?, ?, ?, ?)",
+                        [(serial, register) + tuple(None if field is None else str(field) for field in meta.get(register, (None, None))) for register in new])
+                for id, name in self.connection.execute("SELECT id, name FROM registers WHERE serial = ?", (serial,)):
+                    self.register_ids[(serial, name)] = id
+
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO samples (register_id, ts, value) VALUES (?, ?, ?)",
+                    [(self.register_ids[(serial, register)], timestamp, value) for register, value in values.items()])
+                self.connection.execute("INSERT OR IGNORE INTO scrapes (serial, ts) VALUES (?, ?)", (serial, timestamp))
+            self.scrapes[serial] = self.scrapes.get(serial, 0) + 1
+
+    def series(self, serial, register, start=None, end=None, method=None):
+        """Timestamps and values of one register between start and end (epoch seconds).
+        Rolled up buckets return the aggregate matching method (min, max, last, otherwise avg).
+        """
+        id = self.register_ids.get((serial, register))
+        if id is None:
+            return [], []
+        start = -math.inf if start is None else start
+        end = math.inf if end is None else end
+        column = method if method in ("min", "max", "last") else "avg"
+        rows = self._reader().execute(
+            f"SELECT ts, {column} FROM rollups WHERE register_id = ? AND ts > ? AND ts <= ? "
+            "UNION ALL SELECT ts, value FROM samples WHERE register_id = ? AND ts > ? AND ts <= ? ORDER BY ts",
+            (id, start, end, id, start, end)).fetchall()
+        return [row[0] for row in rows], [row[1] for row in rows]
+
+    def nbytes(self):
+        page_count = self._reader().execute("PRAGMA page_count").fetchone()[0]
+        page_size = self._reader().execute("PRAGMA page_size").fetchone()[0]
+        return page_count * page_size
+
+    def compact(self, now=None):
+        """Roll up raw samples older than raw_days and drop rollups older than retention_days"""
+        now = time.time() if now is None else now
+        # Only whole buckets are rolled up, so a bucket is never rolled up twice
+        cutoff = math.floor((now - self.raw) / self.step) * self.step
+        compact_start = time.perf_counter()
+        with self.lock:
+            with self.connection:
+                self.connection.execute(ROLLUP, {"step": self.step, "cutoff": cutoff})
+                rolled = self.connection.execute("DELETE FROM samples WHERE ts < ?", (cutoff,)).rowcount
+                for serial, count in self.connection.execute("SELECT serial, count(*) FROM scrapes WHERE ts < ? GROUP BY serial", (cutoff,)).fetchall():
+                    self.scrapes[serial] = self.scrapes.get(serial, 0) - count
+                self.connection.execute("DELETE FROM scrapes WHERE ts < ?", (cutoff,))
+                expired = self.connection.execute("DELETE FROM rollups WHERE ts < ?", (now - self.retention,)).rowcount
+            self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        logging.debug(f"History: Compacted {rolled} samples, expired {expired} rollups in {round(time.perf_counter() - compact_start, 3)} secs")
+
+    def _compact_loop(self):
+        while not self.stopped.wait(self.compact_interval):
+            try:
+                self.compact()
+            except Exception as err:
+                logging.error(f"History: Compaction failed: {err}")
+
+    def close(self):
+        self.stopped.set()
+        with self.lock:
+            self.connection.close()
+
+    def view(self, serial):
+        return StoredSeries(self, serial)
+
+
+class StoredSeries(object):
+    """History of one inverter in a HistoryStore, used like a TimeSeriesBuffer"""
+    def __init__(self, store, serial):
+        self.store = store
+        self.serial = serial
+
+    def __len__(self):
+        return self.store.scrapes.get(self.serial, 0)
+
+    def nbytes(self):
+        return self.store.nbytes()
+
+    def append(self, timestamp, values, meta=None):
+        self.store.append(self.serial, timestamp, values, meta)
+
+    def series(self, register, start=None, end=None, method=None):
+        return self.store.series(self.serial, register, start, end, method)
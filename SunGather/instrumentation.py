@@ -0,0 +1,127 @@
+from threading import Lock
+
+import math
+
+# Seconds, covers a fast LAN Modbus read up to a WiNet-S timing out
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+class Metric(object):
+    """Base of Counter and Histogram, one series per set of label values"""
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.series = {}
+        # Label strings are formatted the first time a label set is seen, not every scrape
+        self.label_strings = {}
+        self.lock = Lock()
+
+    def _labels(self, labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        if key not in self.label_strings:
+            self.label_strings[key] = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key))
+        return key
+
+    def header(self, openmetrics=False):
+        # OpenMetrics names the counter family without _total, the text format names the sample
+        name = self.name if openmetrics or self.kind != "counter" else f"{self.name}_total"
+        return f"# HELP {name} {self.help}\n# TYPE {name} {self.kind}\n"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._labels(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self, openmetrics=False):
+        with self.lock:
+            series = list(self.series.items())
+        lines = [f"{self.name}_total{{{self.label_strings[key]}}} {_format_value(value)}\n" for key, value in series]
+        return self.header(openmetrics) + "".join(lines)
+
+    def snapshot(self):
+        with self.lock:
+            return [dict(zip(self.labelnames, key), value=value) for key, value in self.series.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._labels(labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][index] += 1
+                    break
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self, openmetrics=False):
+        with self.lock:
+            series = [(key, list(value["counts"]), value["sum"], value["count"]) for key, value in self.series.items()]
+        lines = []
+        for key, counts, total, count in series:
+            labels = self.label_strings[key]
+            separator = "," if labels else ""
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                lines.append(f'{self.name}_bucket{{{labels}{separator}le="{_format_value(bound)}"}} {cumulative}\n')
+            lines.append(f"{self.name}_sum{{{labels}}} {repr(round(total, 6))}\n")
+            lines.append(f"{self.name}_count{{{labels}}} {count}\n")
+        return self.header(openmetrics) + "".join(lines)
+
+    def snapshot(self):
+        with self.lock:
+            return [dict(zip(self.labelnames, key), count=value["count"], sum=round(value["sum"], 6)) for key, value in self.series.items()]
+
+
+class Registry(object):
+    """Process wide set of SunGather timing metrics, rendered in the Prometheus text format"""
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self, openmetrics=False):
+        return "".join(metric.render(openmetrics) for metric in self.metrics if metric.series)
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+
+REGISTRY = Registry()
+
+CONNECT_SECONDS = REGISTRY.register(Histogram("sungather_connect_seconds", "Time taken to open a connection to the inverter", ["inverter"]))
+BLOCK_READ_SECONDS = REGISTRY.register(Histogram("sungather_block_read_seconds", "Time taken by each block read of the scan plan", ["inverter", "type", "start"]))
+DECODE_SECONDS = REGISTRY.register(Histogram("sungather_decode_seconds", "Time spent decoding registers each scrape, scrape time less block reads", ["inverter"], buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)))
+SCRAPE_SECONDS = REGISTRY.register(Histogram("sungather_scrape_seconds", "Time taken by a whole scrape including connecting", ["inverter"]))
+PUBLISH_SECONDS = REGISTRY.register(Histogram("sungather_export_publish_seconds", "Time taken by each export's publish()", ["export"]))
+SCRAPE_FAILURES = REGISTRY.register(Counter("sungather_scrape_failures", "Scrapes that returned no data", ["inverter"]))
+RECONNECTS = REGISTRY.register(Counter("sungather_reconnects", "New inverter sessions opened after a failed scrape", ["inverter"]))
+EXPORTS_SKIPPED = REGISTRY.register(Counter("sungather_export_skipped", "Scrapes not published by an export (dropped, coalesced or failed)", ["export", "reason"]))
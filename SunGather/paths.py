@@ -0,0 +1,8 @@
+import os
+
+def data_dir():
+    """Directory for the files SunGather keeps between restarts, SUNGATHER_DATA or ~/.sungather"""
+    return os.environ.get('SUNGATHER_DATA') or os.path.join(os.path.expanduser("~"), ".sungather")
+
+def data_path(filename):
+    return os.path.join(data_dir(), filename)
@@ -0,0 +1,159 @@
+from scanplan import build_scan_plan, describe_scan_plan, log_scan_plan
+from instrumentation import CONNECT_SECONDS, BLOCK_READ_SECONDS, DECODE_SECONDS, SCRAPE_SECONDS, SCRAPE_FAILURES, RECONNECTS
+
+import logging
+import time
+
+POLL_TIERS = ("fast", "normal", "slow", "once")
+
+# Registers scrape() folds into timestamp, they are never in latest_scrape themselves
+TIMESTAMP_PARTS = ("year", "month", "day", "hour", "minute", "second")
+
+# Every register scrape() removes after reading it, timestamp and alarm_timestamp parts
+FOLDED = TIMESTAMP_PARTS + tuple(f"alarm_time_{part}" for part in TIMESTAMP_PARTS)
+
+# Registers SungrowClient.scrape() needs on every scan to build timestamp and run_state
+ALWAYS_FAST = TIMESTAMP_PARTS + ("start_stop", "work_state_1")
+
+class InverterPoller(object):
+    """Wraps one SungrowClient with the connect / scrape / close cycle used by the polling loop"""
+    def __init__(self, inverter):
+        self.inverter = inverter
+        self.host = f"{inverter.client_config.get('host')}:{inverter.client_config.get('port')}"
+        self.scan_quirks = None
+        self.scan_gap = None
+        # Polling tiers, only used when poll_tiers is configured
+        self.tier_intervals = None
+        self.tier_plans = {}
+        self.tier_registers = {}
+        self.tier_last_read = {}
+        self.last_values = {}
+        self.read_time = 0.0
+
+    def optimise_scans(self, quirks, max_gap):
+        """Replace the registers file scan list with one built from the registers this inverter uses"""
+        self.scan_quirks = quirks
+        self.scan_gap = max_gap
+        static_plan = self.inverter.register_ranges
+        plan = build_scan_plan(self.inverter.registers, self.inverter.inverter_config.get('model'), max_gap, quirks=quirks)
+        log_scan_plan(plan, static_plan, self.inverter.registers)
+        self.inverter.register_ranges = plan
+
+    def configure_tiers(self, intervals, overrides=None):
+        """Split the scan plan into fast, normal, slow and once tiers, each read at its own interval.
+
+        A register's tier comes from overrides, then the registers file poll: attribute,
+        then normal. An interval of 0 reads the tier once at startup.
+        """
+        if self.scan_quirks is None:
+            logging.warning(f"{self.serial}: poll_tiers requires scan_plan: auto, reading every register each scan")
+            return False
+        overrides = overrides or {}
+        model = self.inverter.inverter_config.get('model')
+
+        for tier in POLL_TIERS:
+            self.tier_registers[tier] = []
+        for register in self.inverter.registers:
+            tier = overrides.get(register['name'], register.get('poll', "normal"))
+            if register['name'] in ALWAYS_FAST:
+                tier = "fast"
+            if tier not in POLL_TIERS:
+                logging.warning(f"{self.serial}: {register['name']} has unknown poll tier {tier}, Valid options are: {', '.join(POLL_TIERS)}")
+                tier = "normal"
+            self.tier_registers[tier].append(register)
+
+        self.tier_intervals = intervals
+        for tier in POLL_TIERS:
+            self.tier_plans[tier] = build_scan_plan(self.tier_registers[tier], model, self.scan_gap, quirks=self.scan_quirks)
+            logging.info(f"{self.serial}: Poll tier {tier}: {len(self.tier_registers[tier])} registers in {len(self.tier_plans[tier])} reads, every {intervals[tier] if intervals[tier] else 'startup only'}{' secs' if intervals[tier] else ''}")
+        return True
+
+    def describe_scans(self):
+        if self.tier_intervals:
+            return "\n".join(f"Tier {tier}:\n" + describe_scan_plan(self.tier_plans[tier], self.tier_registers[tier]) for tier in POLL_TIERS)
+        return describe_scan_plan(self.inverter.register_ranges, self.inverter.registers)
+
+    def _due_tiers(self):
+        now = time.monotonic()
+        # Allow half a scan of slack so jitter does not push a tier back a whole scan, fast is read every scan
+        slack = self.inverter.inverter_config.get('scan_interval') / 2
+        due = []
+        for tier in POLL_TIERS:
+            last_read = self.tier_last_read.get(tier)
+            if last_read is None or tier == "fast":
+                due.append(tier)
+            elif self.tier_intervals[tier] and now - last_read >= self.tier_intervals[tier] - slack:
+                due.append(tier)
+        return due
+
+    @property
+    def serial(self):
+        return self.inverter.getSerialNumber() or self.host
+
+    def _instrument_client(self):
+        """Time each block read, the client is recreated by SungrowClient after a disconnect"""
+        client = self.inverter.client
+        if client is None or getattr(client, 'sungather_timed', False):
+            return
+        serial = self.serial
+        for method, register_type in (("read_input_registers", "read"), ("read_holding_registers", "hold")):
+            def timed_read(start, *args, _read=getattr(client, method), _type=register_type, **kwargs):
+                read_start = time.perf_counter()
+                try:
+                    return _read(start, *args, **kwargs)
+                finally:
+                    duration = time.perf_counter() - read_start
+                    self.read_time += duration
+                    BLOCK_READ_SECONDS.observe(duration, inverter=serial, type=_type, start=start)
+            setattr(client, method, timed_read)
+        client.sungather_timed = True
+
+    def poll(self):
+        if self.tier_intervals:
+            due_tiers = self._due_tiers()
+            self.inverter.register_ranges = [block for tier in due_tiers for block in self.tier_plans[tier]]
+            logging.debug(f"{self.serial}: Reading poll tiers: {', '.join(due_tiers)}")
+
+        scrape_start = time.perf_counter()
+        # The client is only dropped by disconnect() after a failed scrape, a new one means a reconnect
+        if self.inverter.client is None:
+            RECONNECTS.inc(inverter=self.serial)
+        if not (self.inverter.client and self.inverter.client.is_socket_open()):
+            self.inverter.checkConnection()
+            CONNECT_SECONDS.observe(time.perf_counter() - scrape_start, inverter=self.serial)
+        self._instrument_client()
+
+        self.read_time = 0.0
+        try:
+            decode_start = time.perf_counter()
+            success = self.inverter.scrape()
+            if success:
+                DECODE_SECONDS.observe(max(0.0, time.perf_counter() - decode_start - self.read_time), inverter=self.serial)
+        except Exception as e:
+            logging.exception(f"{self.serial}: Failed to scrape: {e}")
+            success = False
+        SCRAPE_SECONDS.observe(time.perf_counter() - scrape_start, inverter=self.serial)
+
+        if success:
+            if self.tier_intervals:
+                now = time.monotonic()
+                for tier in due_tiers:
+                    # A failed block read leaves its registers out, the tier stays due (once is retried) until all are read
+                    missing = [register['name'] for register in self.tier_registers[tier] if register['name'] not in self.inverter.latest_scrape and register['name'] not in FOLDED]
+                    if missing:
+                        logging.debug(f"{self.serial}: Poll tier {tier} incomplete, missing {', '.join(missing)}")
+                    else:
+                        self.tier_last_read[tier] = now
+                # Registers not read this scan keep their last value
+                for tier in POLL_TIERS:
+                    for register in self.tier_registers[tier]:
+                        if register['name'] not in self.inverter.latest_scrape and register['name'] in self.last_values:
+                            self.inverter.latest_scrape[register['name']] = self.last_values[register['name']]
+                self.last_values = dict(self.inverter.latest_scrape)
+            if not self.inverter.inverter_config['connection'] == "http": self.inverter.close()
+        else:
+            SCRAPE_FAILURES.inc(inverter=self.serial)
+            self.inverter.disconnect()
+            logging.warning(f"{self.serial}: Data collection failed, skipped exporting data")
+
+        return success
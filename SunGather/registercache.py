@@ -0,0 +1,116 @@
+import copy
+import hashlib
+import logging
+import marshal
+import os
+import sys
+import time
+import yaml
+
+# Use the LibYAML loader when PyYAML was built with it, it is many times faster than the pure Python one
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+class RegisterCache(object):
+    """Compiled copy of the registers file, so restarts skip YAML parsing and register filtering.
+
+    The cache holds the parsed registers file and the filtered register list for each
+    model / level / smart_meter combination seen. It is stored with marshal (plain
+    dicts and lists only) and rebuilt whenever the registers file or Python version changes.
+    """
+    FORMAT = 1
+
+    def __init__(self, registersfilename, cache_path=None):
+        self.registersfilename = registersfilename
+        self.cache_path = cache_path
+        self.registersfile = None
+        self.filtered = {}
+        self.digest = None
+        self.dirty = False
+
+    def _key(self):
+        return {
+            "format": RegisterCache.FORMAT,
+            "python": list(sys.version_info[:2]),
+            "digest": self.digest
+        }
+
+    def load(self):
+        """Return the parsed registers file, from the cache if it is still valid"""
+        load_start = time.perf_counter()
+        with open(self.registersfilename, 'rb') as f:
+            raw = f.read()
+        self.digest = hashlib.sha256(raw).hexdigest()
+
+        if self.cache_path:
+            try:
+                with open(self.cache_path, 'rb') as f:
+                    cache = marshal.load(f)
+                if cache.get('key') == self._key():
+                    self.registersfile = cache['registers']
+                    self.filtered = cache['filtered']
+                    logging.info(f"Loaded registers from cache: {self.cache_path} in {round(time.perf_counter() - load_start, 3)} secs")
+                    return self.registersfile
+                logging.info(f"Registers cache is out of date, rebuilding: {self.cache_path}")
+            except FileNotFoundError:
+                pass
+            except Exception as err:
+                logging.warning(f"Failed: Loading registers cache: {self.cache_path} {err}")
+
+        self.registersfile = yaml.load(raw.decode("utf-8"), Loader=YamlLoader)
+        self.filtered = {}
+        self.dirty = True
+        logging.debug(f"Parsed registers file with {YamlLoader.__name__} in {round(time.perf_counter() - load_start, 3)} secs")
+        return self.registersfile
+
+    def _detection_file(self):
+        """Registers file cut down to the registers SungrowClient needs for model and serial detection"""
+        return {
+            "registers": [
+                {"read": [copy.deepcopy(register) for register in self.registersfile['registers'][0]['read'] if register.get('name') in ("device_type_code", "serial_number")]},
+                {"hold": []}
+            ],
+            "scan": [{"read": []}, {"hold": []}]
+        }
+
+    def configure(self, inverter):
+        """Same as inverter.configure_registers(), using the cached register list when there is one"""
+        if not inverter.inverter_config.get('model') or not inverter.inverter_config.get('serial_number'):
+            inverter.configure_registers(self._detection_file())
+            inverter.registers = []
+            inverter.register_ranges = []
+
+        key = f"{inverter.inverter_config.get('model')}|{inverter.inverter_config.get('level')}|{bool(inverter.inverter_config.get('smart_meter'))}"
+        if key in self.filtered:
+            # Inverters sharing a model and level share one register list, it is read only after configuration
+            inverter.registers = self.filtered[key]['registers']
+            inverter.register_ranges = copy.deepcopy(self.filtered[key]['register_ranges'])
+            logging.debug(f"Registers for {key} loaded from cache")
+            return True
+
+        inverter.configure_registers(copy.deepcopy(self.registersfile))
+        if inverter.inverter_config.get('model'):
+            self.filtered[key] = {
+                "registers": inverter.registers,
+                "register_ranges": copy.deepcopy(inverter.register_ranges)
+            }
+            self.dirty = True
+        return True
+
+    def save(self):
+        if not self.cache_path or not self.dirty:
+            return False
+        try:
+            # Write then rename, so a crash never leaves a half written cache behind
+            tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                marshal.dump({"key": self._key(), "registers": self.registersfile, "filtered": self.filtered}, f)
+            os.replace(tmp_path, self.cache_path)
+            self.dirty = False
+            logging.info(f"Saved registers cache: {self.cache_path}")
+            return True
+        except Exception as err:
+            logging.warning(f"Registers cache not saved, startup will parse the registers file again: {self.cache_path} {err}")
+            try: os.remove(tmp_path)
+            except OSError: pass
+            return False
@@ -0,0 +1,89 @@
+import logging
+
+# Registers read by each datatype, UTF-8 is only used for the serial number (SungrowClient decodes 5 registers, 10 characters)
+DATATYPE_WIDTH = {
+    "U16": 1,
+    "S16": 1,
+    "U32": 2,
+    "S32": 2,
+    "UTF-8": 5
+}
+
+# Modbus limit for a single read of input or holding registers
+MODBUS_MAX_REGISTERS = 125
+
+def register_width(register):
+    return DATATYPE_WIDTH.get(register.get('datatype'), 1)
+
+def _applies(quirk, register_type, model):
+    if quirk.get('type', register_type) != register_type:
+        return False
+    if quirk.get('models') and model not in quirk.get('models'):
+        return False
+    return True
+
+def build_scan_plan(registers, model=None, max_gap=100, max_block=MODBUS_MAX_REGISTERS, quirks=None):
+    """Build the smallest list of block reads covering the given registers.
+
+    registers are the filtered SungrowClient registers (name, type, address, datatype).
+    Registers closer than max_gap unused registers are merged into one read, reads never
+    exceed max_block registers or cross a quirk boundary, and quirk skip addresses are
+    left out. Returns ranges in SungrowClient register_ranges format, start is address - 1.
+    """
+    quirks = quirks or {}
+    max_block = min(int(quirks.get('max_block', max_block)), int(max_block), MODBUS_MAX_REGISTERS)
+    plan = []
+
+    for register_type in ("read", "hold"):
+        boundaries = sorted(quirk['address'] for quirk in quirks.get('boundaries', []) if _applies(quirk, register_type, model))
+        skip = [quirk['address'] for quirk in quirks.get('skip', []) if _applies(quirk, register_type, model)]
+
+        spans = sorted(set(
+            (register['address'], register['address'] + register_width(register) - 1)
+            for register in registers
+            if register.get('type') == register_type and isinstance(register.get('address'), int) and register['address'] not in skip
+        ))
+
+        # Some addresses are defined twice (e.g. S16 and S32 backup power), SungrowClient decodes every
+        # register starting in a read, so overlapping registers must never be split across reads
+        merged = []
+        for first, last in spans:
+            if merged and first <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], last)
+            else:
+                merged.append([first, last])
+        spans = merged
+
+        block = None
+        for first, last in spans:
+            if block:
+                crosses_boundary = any(block[0] < boundary <= last for boundary in boundaries)
+                if not crosses_boundary and first - block[1] - 1 <= max_gap and last - block[0] + 1 <= max_block:
+                    block[1] = max(block[1], last)
+                    continue
+                plan.append({"type": register_type, "start": block[0] - 1, "range": block[1] - block[0] + 1})
+            block = [first, last]
+        if block:
+            plan.append({"type": register_type, "start": block[0] - 1, "range": block[1] - block[0] + 1})
+
+    return plan
+
+def describe_scan_plan(plan, registers):
+    """Human readable table of a scan plan, one line per block read"""
+    lines = [f"{'Type':<5} {'Start':>6} {'Range':>6}  Registers"]
+    total_registers = 0
+    for block in plan:
+        names = [
+            register['name'] for register in registers
+            if register.get('type') == block['type'] and isinstance(register.get('address'), int)
+            and block['start'] < register['address'] <= block['start'] + block['range']
+        ]
+        total_registers += block['range']
+        lines.append(f"{block['type']:<5} {block['start']:>6} {block['range']:>6}  {len(names):>3}: {', '.join(names)}")
+    lines.append(f"{len(plan)} round-trips per scan, {total_registers} registers read")
+    return "\n".join(lines)
+
+def log_scan_plan(plan, static_plan, registers):
+    logging.info(f"Scan plan: {len(plan)} round-trips per scan (registers file scan section: {len(static_plan)})")
+    for line in describe_scan_plan(plan, registers).split("\n"):
+        logging.debug(f"Scan plan: {line}")
@@ -0,0 +1,75 @@
+import logging
+import time
+
+class DeadlineScheduler(object):
+    """Fixed rate scheduler for the polling loop.
+
+    Deadlines are kept on the monotonic clock, so a slow scrape never shifts the
+    following ones. With align enabled deadlines fall on wall clock multiples of
+    the interval (e.g. :00 and :30 for 30 secs). Ticks missed because a scrape ran
+    over are skipped rather than run back to back.
+    """
+    def __init__(self, interval, align=True):
+        self.interval = float(interval)
+        self.align = align
+        self.next_deadline = None
+        self.clock_offset = None
+        self.stats = {
+            "ticks": 0,
+            "overruns": 0,
+            "skipped_ticks": 0,
+            "last_jitter": 0.0,
+            "max_jitter": 0.0,
+            "mean_jitter": 0.0
+        }
+
+    def _first_deadline(self):
+        now_wall = time.time()
+        now_mono = time.monotonic()
+        self.clock_offset = now_wall - now_mono
+        if self.align:
+            return now_mono + (self.interval - (now_wall % self.interval))
+        return now_mono + self.interval
+
+    def start(self):
+        """Schedule the first deadline, the caller runs its first scrape straight away"""
+        self.next_deadline = self._first_deadline()
+
+    def time_to_next(self):
+        if self.next_deadline is None:
+            self.start()
+        return self.next_deadline - time.monotonic()
+
+    def wait(self):
+        """Sleep until the next deadline, returns the deadline (monotonic) that was hit"""
+        if self.next_deadline is None:
+            self.start()
+
+        # Wall clock was stepped (NTP sync, DST is not an issue as time.time() is UTC), realign to it
+        if self.align and abs((time.time() - time.monotonic()) - self.clock_offset) > 1:
+            logging.info(f"Scheduler: System clock changed, realigning scan schedule")
+            self.next_deadline = self._first_deadline()
+
+        now = time.monotonic()
+        if now > self.next_deadline:
+            missed = int((now - self.next_deadline) // self.interval) + 1
+            self.stats["overruns"] += 1
+            self.stats["skipped_ticks"] += missed
+            self.next_deadline += missed * self.interval
+            logging.warning(f"SunGather is taking longer to process than interval {int(self.interval)}, skipped {missed} scan(s), Please increase scan interval")
+
+        while True:
+            remaining = self.next_deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(remaining)
+
+        deadline = self.next_deadline
+        jitter = time.monotonic() - deadline
+        self.stats["ticks"] += 1
+        self.stats["last_jitter"] = round(jitter, 4)
+        self.stats["max_jitter"] = round(max(self.stats["max_jitter"], jitter), 4)
+        self.stats["mean_jitter"] = round(self.stats["mean_jitter"] + (jitter - self.stats["mean_jitter"]) / self.stats["ticks"], 4)
+
+        self.next_deadline += self.interval
+        return deadline
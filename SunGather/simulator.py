@@ -0,0 +1,348 @@
+#!/usr/bin/python3
+"""Modbus TCP inverter simulator, serves the registers in registers-sungrow.yaml.
+
+Run SunGather against it with connection: modbus, host 127.0.0.1 and the
+simulator port. Values change over time (a solar day compressed into
+--day secs), and latency, dropped connections and failed block reads can be
+injected to test the polling loop and scan plan without an inverter.
+"""
+
+from version import __version__
+from registercache import YamlLoader
+from scanplan import DATATYPE_WIDTH
+
+import getopt
+import logging
+import math
+import random
+import socketserver
+import struct
+import sys
+import threading
+import time
+import yaml
+
+# Modbus exception codes
+ILLEGAL_FUNCTION = 1
+ILLEGAL_DATA_ADDRESS = 2
+ILLEGAL_DATA_VALUE = 3
+SERVER_DEVICE_FAILURE = 4
+
+# Preferred datarange values, so the simulated inverter looks like it is running
+PREFERRED_VALUES = ("Run", "Start", "Running", "Grid-connected", "Enabled", "Normal")
+
+class SimulatedInverter(object):
+    """Register values of one simulated inverter, regenerated on every read"""
+    def __init__(self, registersfile, model, serial_number, rated_power=10000, day_length=86400):
+        self.model = model
+        self.serial_number = f"{serial_number:<10}"[:10]
+        self.rated_power = rated_power
+        self.day_length = day_length
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+        # Energy counters: {register: (kWh, monotonic time of the last read)}, each advances by the time since it was last read
+        self.energy = {}
+        self.registers = {"read": [], "hold": []}
+
+        device_type_code = None
+        for register_type in ("read", "hold"):
+            for register in registersfile['registers'][0 if register_type == "read" else 1][register_type]:
+                if register.get('name') == "device_type_code":
+                    for value in register.get('datarange', []):
+                        if value['value'] == model:
+                            device_type_code = value['response']
+                    register = dict(register, fixed=device_type_code)
+                # No model serves every register in the file
+                if model and register.get('models') and model not in register.get('models'):
+                    continue
+                register = dict(register, type=register_type)
+                # Registers sharing an address with a mask are bits of one word, served once
+                if register.get('mask') and any(r['address'] == register['address'] for r in self.registers[register_type]):
+                    continue
+                self.registers[register_type].append(register)
+        if model and device_type_code is None:
+            logging.warning(f"Simulator: Unknown model {model}, model detection will fail, set model in config.yaml")
+
+    def _solar(self):
+        """0 at night, 1 at solar noon, the simulated day starts at the local time the simulator started"""
+        now = time.localtime(self.start_time)
+        day_position = ((time.time() - self.start_time) / self.day_length + (now.tm_hour * 3600 + now.tm_min * 60) / 86400) % 1
+        # Sunrise at 6:00, sunset at 18:00
+        return max(0.0, math.sin((day_position - 0.25) * 2 * math.pi)) ** 1.5
+
+    def _value(self, register, solar, clock):
+        name = register['name']
+        unit = register.get('unit')
+        now = time.localtime()
+
+        if register.get('fixed') is not None:
+            return register['fixed']
+        if register.get('datarange'):
+            if register.get('mask'):
+                return 0
+            responses = register['datarange']
+            for value in responses:
+                if value.get('value') in PREFERRED_VALUES:
+                    return value['response']
+            return responses[0]['response']
+        if register['type'] == "hold" and name in ("year", "month", "day", "hour", "minute", "second"):
+            return {"year": now.tm_year, "month": now.tm_mon, "day": now.tm_mday, "hour": now.tm_hour, "minute": now.tm_min, "second": now.tm_sec}[name]
+
+        power = self.rated_power * solar * random.uniform(0.97, 1.0)
+        if unit == "kWh":
+            # Energy counters only go up, daily counters reset at local midnight
+            energy, updated = self.energy.get(name, (0.0 if "daily" in name else random.uniform(1000, 20000), clock))
+            energy += power * (clock - updated) / 3600000
+            if "daily" in name and now.tm_hour == 0 and now.tm_min == 0:
+                energy = 0.0
+            self.energy[name] = (energy, clock)
+            return energy
+        if unit == "W" or unit == "kW" or unit == "VA" or unit == "var":
+            if "load" in name or "consumption" in name:
+                return random.uniform(300, 1500)
+            if "battery" in name:
+                return power * 0.2
+            return power if unit == "W" else power / 1000
+        if unit == "A":
+            return power / 230 / 3 if "phase" in name else power / 230 / 2
+        if unit == "V":
+            return 230 * random.uniform(0.98, 1.02) if "phase" in name or "grid" in name else 350 * solar + random.uniform(0, 5)
+        if unit == "Hz":
+            return 50 + random.uniform(-0.05, 0.05)
+        if unit == "°C":
+            return 25 + 20 * solar + random.uniform(-0.5, 0.5)
+        if unit == "%":
+            return 50 + 45 * math.sin((time.time() - self.start_time) / self.day_length * 2 * math.pi)
+        if unit == "h":
+            return (time.time() - self.start_time) / 3600 + 10000
+        return 0
+
+    def _encode(self, register, value):
+        """Raw register words for a value, the reverse of SungrowClient.load_registers()"""
+        datatype = register.get('datatype', "U16")
+        if datatype == "UTF-8":
+            encoded = self.serial_number.encode()
+            return [int.from_bytes(encoded[x:x + 2], 'big') for x in range(0, 2 * DATATYPE_WIDTH["UTF-8"], 2)]
+
+        if register.get('accuracy') and not register.get('datarange'):
+            value = value / register['accuracy']
+        value = int(round(value))
+        if datatype == "U16":
+            return [min(max(value, 0), 0xFFFE)]
+        if datatype == "S16":
+            return [min(max(value, -32767), 32766) & 0xFFFF]
+        if datatype == "U32":
+            value = min(max(value, 0), 0xFFFFFFFE)
+            return [value & 0xFFFF, value >> 16]
+        if datatype == "S32":
+            value = min(max(value, -0x7FFFFFFF), 0x7FFFFFFE) & 0xFFFFFFFF
+            return [value & 0xFFFF, value >> 16]
+        return [0]
+
+    def read(self, register_type, start, count):
+        """Words for a block read, start is the 0 based Modbus offset (address - 1)"""
+        words = [0] * count
+        with self.lock:
+            clock = time.monotonic()
+            solar = self._solar()
+            for register in self.registers[register_type]:
+                offset = register['address'] - 1 - start
+                width = DATATYPE_WIDTH.get(register.get('datatype'), 1)
+                if offset + width <= 0 or offset >= count:
+                    continue
+                for x, word in enumerate(self._encode(register, self._value(register, solar, clock))):
+                    if 0 <= offset + x < count:
+                        words[offset + x] = word
+        return words
+
+
+class FaultConfig(object):
+    """Faults injected into the simulator's responses"""
+    def __init__(self, latency=0.0, jitter=0.0, drop=0.0, fail=0.0, fail_blocks=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.drop = drop
+        self.fail = fail
+        self.fail_blocks = fail_blocks or []
+        self.stats = {"connections": 0, "requests": 0, "registers": 0, "dropped": 0, "failed": 0, "errors": 0}
+
+    def failed_block(self, register_type, start, count):
+        for block in self.fail_blocks:
+            if block['type'] == register_type and start < block['last'] and start + count >= block['first']:
+                return True
+        return False
+
+
+class ModbusHandler(socketserver.BaseRequestHandler):
+    """One Modbus TCP connection, handles read input (4) and read holding (3) registers"""
+
+    def _recv(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _exception(self, transaction, unit, function, code):
+        self.server.faults.stats["errors"] += 1
+        return struct.pack('>HHHBBB', transaction, 0, 3, unit, function | 0x80, code)
+
+    def handle(self):
+        faults = self.server.faults
+        faults.stats["connections"] += 1
+        logging.info(f"Simulator: Connection from {self.client_address[0]}:{self.client_address[1]}")
+        while True:
+            header = self._recv(7)
+            if header is None:
+                break
+            transaction, protocol, length, unit = struct.unpack('>HHHB', header)
+            pdu = self._recv(length - 1)
+            if pdu is None:
+                break
+            faults.stats["requests"] += 1
+
+            if faults.latency or faults.jitter:
+                time.sleep(max(0.0, faults.latency + random.uniform(-faults.jitter, faults.jitter)))
+            if faults.drop and random.random() < faults.drop:
+                faults.stats["dropped"] += 1
+                logging.info(f"Simulator: Dropping connection from {self.client_address[0]}:{self.client_address[1]}")
+                break
+
+            function = pdu[0]
+            if function not in (3, 4) or len(pdu) != 5:
+                response = self._exception(transaction, unit, function, ILLEGAL_FUNCTION)
+            else:
+                start, count = struct.unpack('>HH', pdu[1:5])
+                register_type = "read" if function == 4 else "hold"
+                logging.debug(f"Simulator: {register_type}, {start}:{count}")
+                if count < 1 or count > 125:
+                    response = self._exception(transaction, unit, function, ILLEGAL_DATA_VALUE)
+                elif faults.failed_block(register_type, start, count):
+                    faults.stats["failed"] += 1
+                    response = self._exception(transaction, unit, function, ILLEGAL_DATA_ADDRESS)
+                elif faults.fail and random.random() < faults.fail:
+                    faults.stats["failed"] += 1
+                    response = self._exception(transaction, unit, function, SERVER_DEVICE_FAILURE)
+                else:
+                    words = self.server.inverter.read(register_type, start, count)
+                    faults.stats["registers"] += count
+                    response = struct.pack(f'>HHHBBB{count}H', transaction, 0, 3 + count * 2, unit, function, count * 2, *words)
+            try:
+                self.request.sendall(response)
+            except OSError:
+                break
+
+
+class SimulatorServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, inverter, faults):
+        self.inverter = inverter
+        self.faults = faults
+        super().__init__(address, ModbusHandler)
+
+
+def parse_fail_block(arg):
+    """read:5000-5010 style block, addresses as in the registers file"""
+    register_type, _, addresses = arg.partition(':')
+    first, _, last = addresses.partition('-')
+    if register_type not in ("read", "hold") or not first.isnumeric():
+        raise ValueError(f"Invalid block {arg}, use read:5000-5010 or hold:13000")
+    return {"type": register_type, "first": int(first), "last": int(last or first)}
+
+
+def main():
+    registersfilename = 'registers-sungrow.yaml'
+    host = '127.0.0.1'
+    port = 5020
+    model = 'SH10RT'
+    serial_number = 'A221000001'
+    rated_power = 10000
+    day_length = 86400
+    faults = FaultConfig()
+    loglevel = logging.INFO
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hr:m:s:H:p:v:", ["power=", "day=", "latency=", "jitter=", "drop=", "fail=", "fail-block="])
+    except getopt.GetoptError as err:
+        sys.exit(f'{err}, use -h to see all options')
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print(f'\nSunGather Simulator {__version__}')
+            print(f'usage: python3 simulator.py [options]')
+            print(f'\nOptions and arguments:')
+            print(f'-r registers-file.yaml     : Specify registers file.')
+            print(f'-m SH10RT                  : Model to simulate (default SH10RT)')
+            print(f'-s A221000001             : Serial number to report')
+            print(f'-H 127.0.0.1               : Address to listen on, use 0.0.0.0 for all interfaces')
+            print(f'-p 5020                    : Port to listen on')
+            print(f'-v 20                      : Logging Level, 10 = Debug, 20 = Info (default), 30 = Warning, 40 = Error')
+            print(f'--power 10000              : Peak AC power in W')
+            print(f'--day 86400                : Length of a simulated day in secs, shorten to speed up energy counters')
+            print(f'--latency 0.05             : Delay each response by this many secs')
+            print(f'--jitter 0.02              : Random +/- variation added to latency')
+            print(f'--drop 0.01                : Probability of closing the connection instead of responding')
+            print(f'--fail 0.01                : Probability of a response failing with a device failure exception')
+            print(f'--fail-block read:5000-5010: Reads overlapping these addresses fail, can be repeated')
+            print(f'-h                         : print this help message and exit')
+            print(f'\nExample:')
+            print(f'python3 simulator.py -m SG10RT -p 5020 --latency 0.05 --drop 0.01\n')
+            sys.exit()
+        elif opt == '-r':
+            registersfilename = arg
+        elif opt == '-m':
+            model = arg
+        elif opt == '-s':
+            serial_number = arg
+        elif opt == '-H':
+            host = arg
+        elif opt == '-p':
+            port = int(arg)
+        elif opt == '-v':
+            loglevel = int(arg)
+        elif opt == '--power':
+            rated_power = float(arg)
+        elif opt == '--day':
+            day_length = float(arg)
+        elif opt == '--latency':
+            faults.latency = float(arg)
+        elif opt == '--jitter':
+            faults.jitter = float(arg)
+        elif opt == '--drop':
+            faults.drop = float(arg)
+        elif opt == '--fail':
+            faults.fail = float(arg)
+        elif opt == '--fail-block':
+            try:
+                faults.fail_blocks.append(parse_fail_block(arg))
+            except ValueError as err:
+                sys.exit(str(err))
+
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=loglevel, datefmt='%Y-%m-%d %H:%M:%S')
+
+    try:
+        with open(registersfilename, encoding='utf-8') as f:
+            registersfile = yaml.load(f, Loader=YamlLoader)
+    except Exception as err:
+        sys.exit(f"Failed: Loading registers: {registersfilename} {err}")
+
+    inverter = SimulatedInverter(registersfile, model, serial_number, rated_power, day_length)
+    server = SimulatorServer((host, port), inverter, faults)
+    logging.info(f"Simulator: {model} {serial_number} listening on {host}:{port}, {len(inverter.registers['read'])} read and {len(inverter.registers['hold'])} hold registers")
+    if faults.latency or faults.jitter or faults.drop or faults.fail or faults.fail_blocks:
+        logging.info(f"Simulator: Faults: latency {faults.latency}s +/- {faults.jitter}s, drop {faults.drop}, fail {faults.fail}, fail blocks {faults.fail_blocks}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info(f"Simulator: {faults.stats}")
+
+if __name__ == '__main__':
+    main()
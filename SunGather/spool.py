@@ -0,0 +1,76 @@
+from threading import Lock
+
+import json
+import logging
+import os
+import sqlite3
+
+class Spool(object):
+    """Bounded first in, first out store of JSON items for exports that must not lose data.
+
+    Items are kept in SQLite (WAL), each put is one transaction so a crash never
+    loses or half-writes an item that was accepted. Without a path, or when the file
+    cannot be opened, the spool is kept in memory. When max_items is exceeded the
+    oldest items are dropped.
+    """
+    def __init__(self, path=None, max_items=10000, name="Spool"):
+        self.path = path
+        self.max_items = max(int(max_items), 1)
+        self.name = name
+        self.dropped = 0
+        self.lock = Lock()
+
+        if path:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+                self.connection.execute("PRAGMA journal_mode=WAL")
+                self.connection.execute("PRAGMA synchronous=NORMAL")
+            except (OSError, sqlite3.Error) as err:
+                logging.warning(f"{name}: Cannot use {path}, keeping items in memory, they are lost on restart: {err}")
+                self.path = path = None
+        if not path:
+            self.connection = sqlite3.connect(":memory:", check_same_thread=False)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY AUTOINCREMENT, item TEXT NOT NULL)")
+        self.count = self.connection.execute("SELECT count(*) FROM items").fetchone()[0]
+        if self.count:
+            logging.info(f"{name}: {self.count} items waiting from a previous run in {path}")
+
+    def __len__(self):
+        return self.count
+
+    def put(self, item):
+        self.extend([item])
+
+    def extend(self, items):
+        if not items:
+            return
+        with self.lock:
+            with self.connection:
+                self.connection.executemany("INSERT INTO items (item) VALUES (?)", [(json.dumps(item),) for item in items])
+                self.count += len(items)
+                overflow = self.count - self.max_items
+                if overflow > 0:
+                    self.connection.execute("DELETE FROM items WHERE id IN (SELECT id FROM items ORDER BY id LIMIT ?)", (overflow,))
+                    self.count -= overflow
+                    self.dropped += overflow
+            if overflow > 0:
+                logging.warning(f"{self.name}: Full ({self.max_items} items), dropped the {overflow} oldest")
+
+    def peek(self, limit=100):
+        """Oldest items as (id, item), they stay in the spool until ack()"""
+        with self.lock:
+            rows = self.connection.execute("SELECT id, item FROM items ORDER BY id LIMIT ?", (limit,)).fetchall()
+        return [(id, json.loads(item)) for id, item in rows]
+
+    def ack(self, last_id):
+        """Remove every item up to and including last_id"""
+        with self.lock:
+            with self.connection:
+                removed = self.connection.execute("DELETE FROM items WHERE id <= ?", (last_id,)).rowcount
+            self.count = max(self.count - removed, 0)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -2,12 +2,19 @@
 
 from SungrowClient import SungrowClient
 from version import __version__
+from dispatcher import ExportDispatcher
+from scheduler import DeadlineScheduler
+from poller import InverterPoller
+from registercache import RegisterCache, YamlLoader
+from paths import data_path
+from concurrent.futures import ThreadPoolExecutor
 
 import importlib
 import logging
 import logging.handlers
 import sys
 import getopt
+import os
 import yaml
 import time
 import signal
@@ -18,7 +25,7 @@ def main():
     logfolder = ''
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:],"hc:r:l:v:", "runonce")
+        opts, args = getopt.getopt(sys.argv[1:],"hc:r:l:v:", ["runonce", "scanplan"])
     except getopt.GetoptError:
         sys.exit(f'No options passed via command line, use -h to see all options')
 
@@ -35,6 +42,7 @@ def main():
             print(f'-l /logs/                  : Specify folder to store logs.')
             print(f'-v 30                      : Logging Level, 10 = Debug, 20 = Info, 30 = Warning (default), 40 = Error')
             print(f'--runonce                  : Run once then exit')
+            print(f'--scanplan                 : Print the registers read in each scan then exit')
             print(f'-h                         : print this help message and exit (also --help)')
             print(f'\nExample:')
             print(f'python3 sungather.py -c /full/path/config.yaml\n')
@@ -57,44 +65,50 @@ def main():
                 sys.exit(2) 
         elif opt == '--runonce':
             runonce = True
+        elif opt == '--scanplan':
+            scanplan = True
 
     logging.info(f'Starting SunGather {__version__}')
     logging.info(f'Need Help? https://github.com/bohdan-s/SunGather')
     logging.info(f'NEW HomeAssistant Add-on: https://github.com/bohdan-s/hassio-repository')
 
     try:
-        configfile = yaml.safe_load(open(configfilename, encoding="utf-8"))
+        configfile = yaml.load(open(configfilename, encoding="utf-8"), Loader=YamlLoader)
         logging.info(f"Loaded config: {configfilename}")
     except Exception as err:
         logging.error(f"Failed: Loading config: {configfilename} \n\t\t\t     {err}")
         sys.exit(1)
-    if not configfile.get('inverter'):
+    if not configfile.get('inverter') and not configfile.get('inverters'):
         logging.error(f"Failed Loading config, missing Inverter settings")
         sys.exit(f"Failed Loading config, missing Inverter settings")   
 
+    # The parsed registers file is cached next to the config, unless register_cache: False
+    # A read only config directory (the Docker /config volume) falls back to $SUNGATHER_DATA
+    register_cache_path = (configfile.get('inverter') or {}).get('register_cache', True)
+    if register_cache_path is True:
+        config_dir = os.path.dirname(os.path.abspath(configfilename))
+        if os.access(config_dir, os.W_OK):
+            register_cache_path = os.path.join(config_dir, ".registers-cache")
+        else:
+            register_cache_path = data_path(".registers-cache")
+    register_cache = RegisterCache(registersfilename, register_cache_path or None)
+
     try:
-        registersfile = yaml.safe_load(open(registersfilename, encoding="utf-8"))
+        registersfile = register_cache.load()
         logging.info(f"Loaded registers: {registersfilename}")
         logging.info(f"Registers file version: {registersfile.get('version','UNKNOWN')}")
     except Exception as err:
         logging.error(f"Failed: Loading registers: {registersfilename}  {err}")
         sys.exit(f"Failed: Loading registers: {registersfilename} {err}")
-   
-    config_inverter = {
-        "host": configfile['inverter'].get('host',None),
-        "port": configfile['inverter'].get('port',502),
-        "timeout": configfile['inverter'].get('timeout',10),
-        "retries": configfile['inverter'].get('retries',3),
-        "slave": configfile['inverter'].get('slave',0x01),
-        "scan_interval": configfile['inverter'].get('scan_interval',30),
-        "connection": configfile['inverter'].get('connection',"modbus"),
-        "model": configfile['inverter'].get('model',None),
-        "smart_meter": configfile['inverter'].get('smart_meter',False),
-        "use_local_time": configfile['inverter'].get('use_local_time',False),
-        "log_console": configfile['inverter'].get('log_console','WARNING'),
-        "log_file": configfile['inverter'].get('log_file','OFF'),
-        "level": configfile['inverter'].get('level',1)
-    }
+
+    # A single inverter is configured under inverter:, several under inverters: (inverter: then holds shared defaults)
+    inverter_configs = []
+    if configfile.get('inverters'):
+        for inverter_settings in configfile.get('inverters'):
+            inverter_configs.append(load_inverter_config((configfile.get('inverter') or {}) | inverter_settings))
+    else:
+        inverter_configs.append(load_inverter_config(configfile['inverter']))
+    config_inverter = inverter_configs[0]
 
     if 'loglevel' in locals():
         logger.handlers[0].setLevel(loglevel)
@@ -114,24 +128,54 @@ def main():
     logging.info(f"Logging to console set to: {logging.getLevelName(logger.handlers[0].level)}")
     if logger.handlers.__len__() == 3:
         logging.info(f"Logging to file set to: {logging.getLevelName(logger.handlers[2].level)}")
-    
-    logging.debug(f'Inverter Config Loaded: {config_inverter}')    
 
-    if config_inverter.get('host'):
-        inverter = SungrowClient.SungrowClient(config_inverter)
-    else:
-        logging.error(f"Error: host option in config is required")
-        sys.exit("Error: host option in config is required")
+    pollers = []
+    for config_inverter in inverter_configs:
+        logging.debug(f'Inverter Config Loaded: {config_inverter}')    
+
+        if config_inverter.get('host'):
+            inverter = SungrowClient.SungrowClient(config_inverter)
+        else:
+            logging.error(f"Error: host option in config is required")
+            sys.exit("Error: host option in config is required")
+
+        if not inverter.checkConnection():
+            logging.error(f"Error: Connection to inverter failed: {config_inverter.get('host')}:{config_inverter.get('port')}")
+            sys.exit(f"Error: Connection to inverter failed: {config_inverter.get('host')}:{config_inverter.get('port')}")       
+
+        register_cache.configure(inverter)
+        if not inverter.inverter_config['connection'] == "http": inverter.close()
+        pollers.append(InverterPoller(inverter))
+
+        if config_inverter.get('scan_plan') == "auto":
+            pollers[-1].optimise_scans(registersfile.get('scan_plan'), config_inverter.get('scan_gap'))
+        elif not config_inverter.get('scan_plan') == "static":
+            logging.warning(f"scan_plan: Valid options are: auto, static. Using static")
 
-    if not inverter.checkConnection():
-        logging.error(f"Error: Connection to inverter failed: {config_inverter.get('host')}:{config_inverter.get('port')}")
-        sys.exit(f"Error: Connection to inverter failed: {config_inverter.get('host')}:{config_inverter.get('port')}")       
+        if config_inverter.get('poll_tiers') is not None:
+            poll_tiers = {"fast": config_inverter.get('scan_interval'), "normal": 60, "slow": 3600, "once": 0} | (config_inverter.get('poll_tiers') or {})
+            pollers[-1].configure_tiers(poll_tiers, config_inverter.get('poll_overrides'))
 
-    inverter.configure_registers(registersfile)
-    if not inverter.inverter_config['connection'] == "http": inverter.close()
+        if 'scanplan' in locals():
+            print(f"\nScan plan for {pollers[-1].serial} ({inverter.getInverterModel()}, level {config_inverter.get('level')}):")
+            print(pollers[-1].describe_scans())
+
+    register_cache.save()
+
+    if 'scanplan' in locals():
+        sys.exit(0)
+
+    if len(set(poller.serial for poller in pollers)) != len(pollers):
+        logging.error(f"Error: Inverters must have unique serial numbers, set serial: in config if detection fails")
+        sys.exit(f"Error: Inverters must have unique serial numbers, set serial: in config if detection fails")
+
+    # The first inverter is the primary, it is used to configure exports and by single inverter exports such as PVOutput
+    config_inverter = inverter_configs[0]
+    inverter = pollers[0].inverter
     
     # Now we know the inverter is working, lets load the exports
     exports = []
+    dispatcher = ExportDispatcher()
     if configfile.get('exports'):
         for export in configfile.get('exports'):
             try:
@@ -139,12 +183,29 @@ def main():
                     export_load = importlib.import_module("exports." + export.get('name'))
                     logging.info(f"Loading Export: exports {export.get('name')}")
                     exports.append(getattr(export_load, "export_" + export.get('name'))())
-                    retval = exports[-1].configure(export, inverter)
+                    # Exports can be tied to one inverter with serial:, single inverter exports default to the primary
+                    export_inverter = inverter
+                    export_serial = export.get('serial', pollers[0].serial if getattr(exports[-1], 'single_inverter', False) else None)
+                    for poller in pollers:
+                        if poller.serial == export_serial:
+                            export_inverter = poller.inverter
+                    # Lets exports tell inverters apart only when there is more than one (e.g. InfluxDB serial tag)
+                    exports[-1].inverter_count = len(pollers)
+                    retval = exports[-1].configure(export, export_inverter)
+                    dispatcher.add_export(export.get('name'), exports[-1], export, export_serial)
             except Exception as err:
                 logging.error(f"Failed loading export: {err}" +
                             f"\n\t\t\t     Please make sure {export.get('name')}.py exists in the exports folder")
 
     scan_interval = config_inverter.get('scan_interval')
+    scheduler = DeadlineScheduler(scan_interval, config_inverter.get('scan_align'))
+    scheduler.start()
+
+    # Inverters are scraped concurrently, a thread pool keeps the thread count fixed however many inverters there are
+    pool = None
+    if len(pollers) > 1:
+        pool = ThreadPoolExecutor(max_workers=config_inverter.get('poll_workers') or min(len(pollers), 16), thread_name_prefix="poller")
+        logging.info(f"Polling {len(pollers)} inverters")
 
     signal.signal(signal.SIGTERM, handle_sigterm)
 
@@ -152,37 +213,55 @@ def main():
     while True:
         loop_start = time.perf_counter()
 
-        inverter.checkConnection()
-
-        # Scrape the inverter
-        try:
-            success = inverter.scrape()
-        except Exception as e:
-            logging.exception(f"Failed to scrape: {e}")
-            success = False
-
-        if(success):
-            for export in exports:
-                export.publish(inverter)
-            if not inverter.inverter_config['connection'] == "http": inverter.close()
+        # Scrape the inverters
+        if pool:
+            results = list(pool.map(lambda poller: poller.poll(), pollers))
         else:
-            inverter.disconnect()
-            logging.warning(f"Data collection failed, skipped exporting data. Retying in {scan_interval} secs")
+            results = [pollers[0].poll()]
+
+        for poller, success in zip(pollers, results):
+            if success:
+                # Exports run on their own threads, so slow exports do not hold up the next scrape
+                dispatcher.dispatch(poller.inverter, poller.serial)
 
         loop_end = time.perf_counter()
         process_time = round(loop_end - loop_start, 2)
         logging.debug(f'Processing Time: {process_time} secs')
+        logging.debug(f'Export Queues: {dispatcher.stats()}')
+        logging.debug(f'Scheduler: {scheduler.stats}')
 
         if 'runonce' in locals():
+            dispatcher.stop(drain=True)
             sys.exit(0)
         
-        # Sleep until the next scan
-        if scan_interval - process_time <= 1:
-            logging.warning(f"SunGather is taking {process_time} to process, which is longer than interval {scan_interval}, Please increase scan interval")
-            time.sleep(process_time)
-        else:
-            logging.info(f'Next scrape in {int(scan_interval - process_time)} secs')
-            time.sleep(scan_interval - process_time)    
+        # Sleep until the next scan, missed scans are skipped rather than run late
+        if scheduler.time_to_next() > 0:
+            logging.info(f'Next scrape in {int(scheduler.time_to_next())} secs')
+        scheduler.wait()
+
+def load_inverter_config(config):
+    return {
+        "host": config.get('host',None),
+        "port": config.get('port',502),
+        "timeout": config.get('timeout',10),
+        "retries": config.get('retries',3),
+        "slave": config.get('slave',0x01),
+        "scan_interval": config.get('scan_interval',30),
+        "scan_align": config.get('scan_align',True),
+        "scan_plan": config.get('scan_plan',"static"),
+        "scan_gap": config.get('scan_gap',100),
+        "poll_tiers": config.get('poll_tiers',None),
+        "poll_overrides": config.get('poll_overrides',None),
+        "poll_workers": config.get('poll_workers',None),
+        "connection": config.get('connection',"modbus"),
+        "model": config.get('model',None),
+        "serial_number": config.get('serial',None),
+        "smart_meter": config.get('smart_meter',False),
+        "use_local_time": config.get('use_local_time',False),
+        "log_console": config.get('log_console','WARNING'),
+        "log_file": config.get('log_file','OFF'),
+        "level": config.get('level',1)
+    }
 
 def handle_sigterm(signum, frame):
     print("Received SIGTERM, shutting down gracefully...")
@@ -0,0 +1,235 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from threading import Lock
+
+import math
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+class _Timeline(object):
+    """Timestamps in time order, a sequence view over the ring for bisect"""
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def __len__(self):
+        return self.buffer.size
+
+    def __getitem__(self, index):
+        return self.buffer.timestamps[self.buffer._physical(index)]
+
+
+def _single(value):
+    """A 32 bit float without its binary noise, 230.1 would otherwise read back as 230.10000610351562"""
+    return float(f"{value:.7g}")
+
+# 32 bit floats keep 7 significant digits, values at 0.1 accuracy stay exact below this
+FLOAT_LIMIT = 10 ** 6
+
+class Column(object):
+    """Values of one register, a float array for numbers (NaN when missing), a list otherwise.
+
+    Numbers are kept as 32 bit floats, half the memory of doubles and as many digits as most
+    registers have. The column moves to doubles once it sees a value past FLOAT_LIMIT (large totals).
+    """
+    def __init__(self, numeric, length):
+        self.numeric = numeric
+        # Registers that have only ever been integers are returned as int
+        self.integer = numeric
+        self.values = array('f', [math.nan]) * length if numeric else [None] * length
+
+    def encode(self, value):
+        if not self.numeric:
+            return value
+        if not _is_number(value):
+            return math.nan
+        if self.integer and not isinstance(value, int):
+            self.integer = False
+        if abs(value) >= FLOAT_LIMIT and self.values.typecode == 'f':
+            self.values = array('d', map(_single, self.values))
+        return float(value)
+
+    def decode(self, value):
+        if not self.numeric:
+            return value
+        if value != value:
+            return None
+        if self.integer:
+            return int(value)
+        return _single(value) if self.values.typecode == 'f' else value
+
+
+class TimeSeriesBuffer(object):
+    """Columnar ring buffer of scrapes.
+
+    One timestamp array (epoch seconds) shared by one array per register, unit and
+    address are kept once per register. Time ranges are found by binary search.
+    """
+    def __init__(self, capacity=1440, registers=None):
+        self.capacity = max(int(capacity), 1)
+        self.registers = set(registers) if registers else None
+        self.timestamps = array('d')
+        self.columns = {}
+        self.meta = {}      # register: {"unit", "address"}
+        self.start = 0      # physical index of the oldest point once the ring is full
+        self.size = 0
+        self.timeline = _Timeline(self)
+        self.lock = Lock()
+
+    def __len__(self):
+        return self.size
+
+    def _physical(self, index):
+        return (self.start + index) % self.capacity if self.size == self.capacity else index
+
+    def nbytes(self):
+        total = self.timestamps.itemsize * len(self.timestamps)
+        for column in self.columns.values():
+            total += column.values.itemsize * len(column.values) if column.numeric else 8 * len(column.values)
+        return total
+
+    def append(self, timestamp, values, meta=None):
+        """Add one scrape, values is {register: value}, meta is {register: (unit, address)}"""
+        with self.lock:
+            # Keep the timeline sorted if the clock steps back
+            if self.size and timestamp < self.timeline[self.size - 1]:
+                timestamp = self.timeline[self.size - 1]
+
+            for register, value in values.items():
+                if register in self.columns or (self.registers is not None and register not in self.registers):
+                    continue
+                if value is None:
+                    continue
+                self.columns[register] = Column(_is_number(value), len(self.timestamps))
+                if meta and register in meta:
+                    unit, address = meta[register]
+                    self.meta[register] = {"unit": unit, "address": address}
+
+            if self.size < self.capacity:
+                self.timestamps.append(timestamp)
+                for register, column in self.columns.items():
+                    # encode() may replace the array, so it runs before the array is looked up
+                    value = column.encode(values.get(register))
+                    column.values.append(value)
+                self.size += 1
+            else:
+                index = self.start
+                self.timestamps[index] = timestamp
+                for register, column in self.columns.items():
+                    value = column.encode(values.get(register))
+                    column.values[index] = value
+                self.start = (self.start + 1) % self.capacity
+
+    def span(self, start=None, end=None):
+        """Logical index range of the points with start < timestamp <= end"""
+        low = 0 if start is None else bisect_right(self.timeline, start)
+        high = self.size if end is None else bisect_right(self.timeline, end)
+        return low, high
+
+    def series(self, register, start=None, end=None, method=None):
+        """Timestamps and values of one register between start and end (epoch seconds), missing values are left out.
+        method is accepted for compatibility with a HistoryStore, every point is kept raw.
+        """
+        with self.lock:
+            column = self.columns.get(register)
+            if column is None:
+                return [], []
+            low, high = self.span(start, end)
+            timestamps = []
+            values = []
+            for index in range(low, high):
+                physical = self._physical(index)
+                value = column.decode(column.values[physical])
+                if value is None:
+                    continue
+                timestamps.append(self.timestamps[physical])
+                values.append(value)
+            return timestamps, values
+
+
+AGGREGATES = ("avg", "min", "max", "last", "lttb")
+
+def downsample(timestamps, values, step=None, max_points=None, method="avg"):
+    """Reduce a series to buckets of step seconds or to about max_points points.
+
+    avg, min, max and last aggregate each bucket (aligned to multiples of step) and
+    timestamp it with the bucket start, lttb keeps the max_points points that best
+    preserve the shape of the line. Non numeric series can only use last.
+    """
+    if step is not None and not (step > 0 and math.isfinite(step)):
+        raise ValueError(f"step must be a positive number of seconds, got {step}")
+    if max_points is not None and max_points < 1:
+        raise ValueError(f"max_points must be at least 1, got {max_points}")
+    if method == "lttb" and max_points is not None and max_points < 3:
+        raise ValueError(f"max_points must be at least 3 for lttb, got {max_points}")
+    if not values or (not step and not max_points):
+        return timestamps, values
+    if method not in AGGREGATES:
+        raise ValueError(f"Unknown method {method}, expected one of {', '.join(AGGREGATES)}")
+    if not _is_number(values[0]):
+        method = "last"
+
+    if method == "lttb":
+        if max_points:
+            return lttb(timestamps, values, max_points)
+        points = int((timestamps[-1] - timestamps[0]) // step) + 1
+        if points >= 3:
+            return lttb(timestamps, values, points)
+        # A step this coarse leaves no point between the first and last to choose, the buckets are averaged instead
+        method = "avg"
+
+    if not step:
+        if len(values) <= max_points:
+            return timestamps, values
+        step = (timestamps[-1] - timestamps[0]) / max_points
+        # Whole seconds keep bucket boundaries stable between refreshes
+        step = max(math.ceil(step), 1)
+
+    reduce = {"avg": lambda bucket: sum(bucket) / len(bucket), "min": min, "max": max, "last": lambda bucket: bucket[-1]}[method]
+    bucket_timestamps = []
+    bucket_values = []
+    low = 0
+    while low < len(timestamps):
+        start = timestamps[low] - timestamps[low] % step
+        # A step below float precision would leave the bucket empty, it always takes at least one point
+        high = max(bisect_left(timestamps, start + step, low), low + 1)
+        bucket_timestamps.append(start)
+        bucket_values.append(reduce(values[low:high]))
+        low = high
+    return bucket_timestamps, bucket_values
+
+def lttb(timestamps, values, threshold):
+    """Largest-Triangle-Three-Buckets, keeps threshold points including the first and last.
+    A threshold below 3 has no bucket to choose from and returns the series unchanged.
+    """
+    length = len(values)
+    if threshold >= length or threshold < 3:
+        return timestamps, values
+
+    sampled_timestamps = [timestamps[0]]
+    sampled_values = [values[0]]
+    every = (length - 2) / (threshold - 2)
+    selected = 0
+    for bucket in range(threshold - 2):
+        # Average of the next bucket is the third corner of the triangle
+        next_start = int((bucket + 1) * every) + 1
+        next_end = min(int((bucket + 2) * every) + 1, length)
+        average_x = sum(timestamps[next_start:next_end]) / (next_end - next_start)
+        average_y = sum(values[next_start:next_end]) / (next_end - next_start)
+
+        point_x = timestamps[selected]
+        point_y = values[selected]
+        best_area = -1
+        best = None
+        for index in range(int(bucket * every) + 1, int((bucket + 1) * every) + 1):
+            area = abs((point_x - average_x) * (values[index] - point_y) - (point_x - timestamps[index]) * (average_y - point_y))
+            if area > best_area:
+                best_area = area
+                best = index
+        sampled_timestamps.append(timestamps[best])
+        sampled_values.append(values[best])
+        selected = best
+
+    sampled_timestamps.append(timestamps[-1])
+    sampled_values.append(values[-1])
+    return sampled_timestamps, sampled_values
@@ -0,0 +1,100 @@
+AGGREGATES = ("mean", "min", "max", "last")
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+class _Running(object):
+    """Time-weighted statistics of one numeric register in the open window"""
+    __slots__ = ("area", "covered", "min", "max", "last", "since")
+
+    def __init__(self, value, since):
+        self.area = 0.0
+        self.covered = 0.0
+        self.min = self.max = self.last = value
+        self.since = since      # when last was read, it holds until the next read
+
+    def hold(self, until):
+        if until > self.since:
+            self.area += self.last * (until - self.since)
+            self.covered += until - self.since
+            self.since = until
+
+    def add(self, value, timestamp):
+        self.hold(timestamp)
+        self.last = value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def mean(self):
+        return self.area / self.covered if self.covered else self.last
+
+
+class Window(object):
+    """Aggregates of one closed window, values is {aggregate: {register: value}}"""
+    def __init__(self, start, end, samples, values):
+        self.start = start
+        self.end = end
+        self.samples = samples
+        self.values = values
+
+
+class WindowAggregator(object):
+    """Tumbling windows of window seconds over the scrapes of one inverter.
+
+    Windows are aligned to the clock (a 300 second window closes at :00, :05, ...).
+    Each scrape updates running statistics, raw scrapes are not kept. The mean is
+    time-weighted, a value holds until the next read, and the last value of a window
+    is carried into the next one when no scrape is missed in between. Registers that
+    are not numbers only keep their last value.
+    """
+    def __init__(self, window):
+        self.window = window
+        self.start = None
+        self.samples = 0
+        self.numeric = {}       # register: _Running
+        self.other = {}         # register: last value
+
+    def add(self, timestamp, values):
+        """Add one scrape, returns the Window it closed, otherwise None"""
+        closed = None
+        start = timestamp - timestamp % self.window
+        if self.start is None:
+            self.start = start
+        elif start > self.start:
+            end = self.start + self.window
+            closed = self.close(end)
+            if start == end:
+                self.numeric = {register: _Running(running.last, end) for register, running in self.numeric.items()}
+            else:
+                # Scrapes were missed for a whole window, the old values are not carried over the gap
+                self.numeric = {}
+                self.other = {}
+            self.start = start
+            self.samples = 0
+
+        # A clock stepping back stays in the open window
+        timestamp = max(timestamp, self.start)
+        for register, value in values.items():
+            if _is_number(value):
+                running = self.numeric.get(register)
+                if running is None:
+                    self.numeric[register] = _Running(value, timestamp)
+                else:
+                    running.add(value, timestamp)
+            elif value is not None:
+                self.other[register] = value
+        self.samples += 1
+        return closed
+
+    def close(self, end):
+        values = {aggregate: dict(self.other) for aggregate in AGGREGATES}
+        mean, low, high, last = (values[aggregate] for aggregate in AGGREGATES)
+        for register, running in self.numeric.items():
+            running.hold(end)
+            mean[register] = running.mean()
+            low[register] = running.min
+            high[register] = running.max
+            last[register] = running.last
+        return Window(self.start, end, self.samples, values)
@@ -18,7 +18,7 @@ export default function ProductionChart() {
   const fetchData = async () => {
     try {
       setLoading(true)
-      const response = await axios.get(`/api/v1/history/daily?hours=${hours}&register=total_active_power`)
+      const response = await axios.get(`/api/v1/history/daily?hours=${hours}&register=total_active_power&max_points=300&method=lttb`)
       
       const formatted = response.data.data.map(point => {
         const date = new Date(point.timestamp)